@@ -2,37 +2,68 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"geturl": "00_external.ipynb",
+index = {"Cksum": "00_external.ipynb",
+         "cksum": "00_external.ipynb",
+         "configure_session": "00_external.ipynb",
+         "get_session": "00_external.ipynb",
+         "geturl": "00_external.ipynb",
+         "download_url": "00_external.ipynb",
          "sync": "00_external.ipynb",
          "USERAGENT": "00_external.ipynb",
+         "CHUNK_SIZE": "00_external.ipynb",
          "DESC": "00_external.ipynb",
+         "download_parallel": "01_download.ipynb",
          "Ladsweb": "01_download.ipynb",
+         "OrderJournal": "01_download.ipynb",
          "read_log": "01_download.ipynb",
          "update_log": "01_download.ipynb",
          "order_status": "01_download.ipynb",
          "download_files": "01_download.ipynb",
          "release_order": "01_download.ipynb",
+         "OrderManager": "01_download.ipynb",
          "order_manager": "01_download.ipynb",
          "run_all": "01_download.ipynb",
          "geoget_ladsweb": "02_cli.ipynb",
          "geoget_order_manager": "02_cli.ipynb",
          "get_config": "03_era5.ipynb",
+         "get_client": "03_era5.ipynb",
          "send_request": "03_era5.ipynb",
          "fwi_set": "03_era5.ipynb",
          "era5_get_year": "03_era5.ipynb",
+         "count_fields": "03_era5.ipynb",
+         "plan_requests": "03_era5.ipynb",
          "era5land_get": "03_era5.ipynb",
+         "ERA5Store": "03_era5.ipynb",
+         "ERA5_SHORT_NAMES": "03_era5.ipynb",
+         "era5_merge": "03_era5.ipynb",
+         "era5_read": "03_era5.ipynb",
          "country_bounding_boxes": "04_geo.ipynb",
          "dict2json": "04_geo.ipynb",
          "Region": "04_geo.ipynb",
+         "run_tiles": "04_geo.ipynb",
          "RegionST": "04_geo.ipynb",
-         "GFS": "05_gfs.ipynb"}
+         "CountryIndex": "04_geo.ipynb",
+         "parse_idx": "05_gfs.ipynb",
+         "select_messages": "05_gfs.ipynb",
+         "byte_ranges": "05_gfs.ipynb",
+         "download_messages": "05_gfs.ipynb",
+         "grib_to_netcdf": "05_gfs.ipynb",
+         "cube_chunks": "05_gfs.ipynb",
+         "GFS_PROD_URL": "05_gfs.ipynb",
+         "SURFACE_LEVELS": "05_gfs.ipynb",
+         "PRESSURE_LEVELS": "05_gfs.ipynb",
+         "GFS": "05_gfs.ipynb",
+         "cache_path": "06_cache.ipynb",
+         "DiskCache": "06_cache.ipynb",
+         "GranuleIndex": "06_cache.ipynb"}
 
 modules = ["external.py",
            "download.py",
            "cli.py",
            "era5.py",
            "geo.py",
-           "gfs.py"]
+           "gfs.py",
+           "cache.py"]
 
 doc_url = "https://mnpinto.github.io/geoget/"
 
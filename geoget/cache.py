@@ -0,0 +1,144 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_cache.ipynb (unless otherwise specified).
+
+__all__ = ['cache_path', 'DiskCache', 'GranuleIndex']
+
+# Cell
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import pandas as pd
+from pathlib import Path
+from time import time
+
+# Cell
+def cache_path(name:str=''):
+    "Path of the geoget cache directory, defined by the `GEOGET_CACHE` environment variable."
+    return Path(os.environ.get('GEOGET_CACHE', '~/.cache/geoget')).expanduser()/name
+
+class DiskCache():
+    "JSON cache saved in `path` whose entries expire after `ttl` seconds, keeping at most `max_size` bytes."
+    def __init__(self, path, ttl:float=24*3600, max_size:int=100*1024**2):
+        self.path = Path(path)
+        self.ttl, self.max_size = ttl, max_size
+
+    def _file(self, key):
+        h = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        return self.path/f'{h}.json'
+
+    def get(self, key, default=None):
+        "Returns the value stored for `key` or `default` if it is missing or expired."
+        file = self._file(key)
+        try:
+            if time() - file.stat().st_mtime > self.ttl:
+                file.unlink()
+                return default
+            with open(file, 'r') as f:
+                return json.load(f)['value']
+        except (OSError, ValueError, KeyError): return default
+
+    def set(self, key, value):
+        "Stores `value` for `key`, evicting the oldest entries if the cache exceeds `max_size`."
+        self.path.mkdir(exist_ok=True, parents=True)
+        file = self._file(key)
+        # Each thread writes its own temporary file so concurrent writes of a key don't clash
+        tmp = file.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'value': value}, f, default=str)
+        os.replace(tmp, file)
+        self.evict()
+
+    def evict(self):
+        "Removes expired entries and then the oldest ones until the cache fits in `max_size`."
+        files = []
+        for file in self.path.glob('*.json'):
+            try: files.append((file, file.stat()))
+            except OSError: pass
+        files.sort(key=lambda o: o[1].st_mtime)
+        size, now = sum(st.st_size for _, st in files), time()
+        for file, st in files:
+            if size <= self.max_size and now - st.st_mtime <= self.ttl: continue
+            try: file.unlink()
+            except OSError: pass
+            size -= st.st_size
+
+    def clear(self):
+        "Removes all entries."
+        for file in self.path.glob('*.json'): file.unlink()
+
+    def __repr__(self):
+        return f'DiskCache({self.path}, ttl={self.ttl}, max_size={self.max_size})'
+
+# Cell
+class GranuleIndex():
+    """SQLite index of granules with their id, filename, product, collection, acquisition time,
+    size, local path and checksum. `bbox` is the bounding box of the search that found the granule."""
+    _columns = ['filename', 'id', 'product', 'collection', 'time', 'size', 'path', 'cksum',
+                'left', 'bottom', 'right', 'top']
+
+    def __init__(self, file):
+        self.file = Path(file)
+        self.file.parent.mkdir(exist_ok=True, parents=True)
+        self._execute('CREATE TABLE IF NOT EXISTS granules (filename TEXT PRIMARY KEY, id TEXT, '
+                      'product TEXT, collection TEXT, time TEXT, size INTEGER, path TEXT, cksum TEXT, '
+                      'left REAL, bottom REAL, right REAL, top REAL)')
+        self._execute('CREATE INDEX IF NOT EXISTS granules_id ON granules (id)')
+        self._execute('CREATE INDEX IF NOT EXISTS granules_time ON granules (product, time)')
+
+    def _execute(self, sql, params=(), many=False):
+        con = sqlite3.connect(str(self.file), timeout=60)
+        try:
+            with con:
+                cur = con.executemany(sql, params) if many else con.execute(sql, params)
+                return cur.fetchall()
+        finally: con.close()
+
+    def add(self, records:list):
+        "Adds or updates granules from a list of dicts with a `filename` key. Missing values are kept."
+        con = sqlite3.connect(str(self.file), timeout=60)
+        try:
+            with con:
+                for r in records:
+                    if 'bbox' in r: r = {**r, **dict(zip(['left', 'bottom', 'right', 'top'], r['bbox']))}
+                    if r.get('time') is not None: r['time'] = str(r['time'])
+                    cols = [c for c in self._columns[1:] if r.get(c) is not None]
+                    con.execute('INSERT OR IGNORE INTO granules (filename) VALUES (?)', (r['filename'],))
+                    if len(cols) == 0: continue
+                    con.execute(f'UPDATE granules SET {", ".join(f"{c}=?" for c in cols)} WHERE filename=?',
+                                [r[c] for c in cols] + [r['filename']])
+        finally: con.close()
+
+    def filenames(self, ids:list):
+        "Dict of id to filename for the `ids` already in the index."
+        out = {}
+        for i in range(0, len(ids), 500):
+            chunk = list(ids[i:i+500])
+            rows = self._execute(f'SELECT id, filename FROM granules WHERE id IN ({",".join("?"*len(chunk))})', chunk)
+            out.update(dict(rows))
+        return out
+
+    def get(self, filename:str):
+        "Dict with the information stored for `filename` or `None` if it is not in the index."
+        rows = self._execute(f'SELECT {", ".join(self._columns)} FROM granules WHERE filename=?', (filename,))
+        return dict(zip(self._columns, rows[0])) if len(rows) > 0 else None
+
+    def query(self, bbox:list=None, tstart=None, tend=None, product:str=None, local:bool=True):
+        """DataFrame with the granules acquired between `tstart` and `tend` found by searches
+        intersecting `bbox`. If `local` only the granules downloaded to a local path are returned."""
+        where, params = [], []
+        if bbox is not None:
+            where.append('left <= ? AND right >= ? AND bottom <= ? AND top >= ?')
+            params += [bbox[2], bbox[0], bbox[3], bbox[1]]
+        if tstart is not None: where, params = where + ['time >= ?'], params + [str(pd.Timestamp(tstart))]
+        if tend is not None: where, params = where + ['time <= ?'], params + [str(pd.Timestamp(tend))]
+        if product is not None: where, params = where + ['product = ?'], params + [product]
+        if local: where.append('path IS NOT NULL')
+        sql = f'SELECT {", ".join(self._columns)} FROM granules'
+        if len(where) > 0: sql += ' WHERE ' + ' AND '.join(where)
+        df = pd.DataFrame(self._execute(sql + ' ORDER BY time', params), columns=self._columns)
+        df['time'] = pd.to_datetime(df['time'])
+        return df
+
+    def __repr__(self):
+        return f'GranuleIndex({self.file})'
\ No newline at end of file
@@ -36,7 +36,7 @@ def geoget_ladsweb(
     lads = Ladsweb(**kwargs)
     lads_list = lads.split_times()
     print(f'Splitting request into {len(lads_list)} orders.')
-    run_parallel(lads_list, path_save, email, auth)
+    run_all(lads_list, path_save)
 
 # Cell
 @call_parse
@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_download.ipynb (unless otherwise specified).
 
-__all__ = ['Ladsweb', 'read_log', 'update_log', 'order_status', 'download_files', 'release_order', 'order_manager',
-           'run_all']
+__all__ = ['download_parallel', 'Ladsweb', 'OrderJournal', 'read_log', 'update_log', 'order_status', 'download_files',
+           'release_order', 'OrderManager', 'order_manager', 'run_all']
 
 # Cell
 from netCDF4 import Dataset
@@ -11,6 +11,7 @@ import pandas as pd
 from rasterio.coords import BoundingBox, disjoint_bounds
 import numpy as np
 import json
+import sqlite3
 import requests
 import warnings
 import re
@@ -18,24 +19,143 @@ import os
 from fastprogress.fastprogress import progress_bar
 from nbdev.imports import test_eq
 from functools import partial
-from concurrent.futures import ThreadPoolExecutor
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import threading
+import asyncio
+from time import sleep, perf_counter
 from datetime import datetime
 import pdb
 
-from .external import geturl
+from .external import geturl, get_session, download_url, Cksum, cksum
+from .cache import DiskCache, GranuleIndex, cache_path
 
 # Cell
+def _validate_netcdf(file):
+    "Raises an exception if `file` can't be opened as a netCDF/HDF file."
+    Dataset(file, mode='r').close()
+
+def download_parallel(urls:list, files:list, auth=None, validate=None, max_workers:int=8,
+                      max_per_host:int=4, n_tries:int=10, wait:float=10):
+    "Download `urls` to `files` with a pool of workers, limiting concurrent transfers per host."
+    hosts = {urlparse(url).netloc for url in urls}
+    semaphores = {host: threading.BoundedSemaphore(max_per_host) for host in hosts}
+
+    def _download(url, file):
+        for _ in range(n_tries):
+            with semaphores[urlparse(url).netloc]:
+                if not download_url(url, file, auth):
+                    warnings.warn(f'Unable to get {url}', UserWarning)
+                    continue
+            # Validation runs outside the host slot so the next transfer can start meanwhile
+            try:
+                if validate is not None: validate(file)
+                return os.path.getsize(file)
+            except Exception:
+                warnings.warn(f'Failed to validate {file}. Trying to download again.', UserWarning)
+                os.remove(file)
+                sleep(wait)
+        return None
+
+    failed, nbytes, t0 = [], 0, perf_counter()
+    with ThreadPoolExecutor(max_workers) as e:
+        futures = {e.submit(_download, url, file): file for url, file in zip(urls, files)}
+        pbar = progress_bar(as_completed(futures), total=len(futures))
+        for future in pbar:
+            size = future.result()
+            if size is None: failed.append(futures[future])
+            else: nbytes += size
+            pbar.comment = f'{nbytes/1e6/(perf_counter()-t0):.1f} MB/s'
+    return failed
+
+# Cell
+def _get_filename(file_id, collection, n_tries=10, wait=1):
+    "Get the filename for a file id, retrying with exponential backoff. Returns `None` on failure."
+    url = f'https://ladsweb.modaps.eosdis.nasa.gov/details/file/{collection}/{file_id}'
+    # Ladsweb will sometimes return 504 timeouts, so we retry up to `n_tries` times
+    for i in range(n_tries):
+        try: return re.findall('<td>File Name</td><td>(.*?)</td>', get_session().get(url, timeout=120).text)[0]
+        except Exception:
+            if i < n_tries-1: sleep(min(wait*2**i, 60))
+    return None
+
+def _get_file_properties(ids:list, n_tries=10, wait=1):
+    """Get the filenames of a batch of file `ids` with a single MODAPS `getFileProperties` request,
+    retrying with exponential backoff. Returns a dict with the ids found, empty on failure."""
+    url = ("https://modwebsrv.modaps.eosdis.nasa.gov/axis2/services/MODAPSservices/" +
+           f"getFileProperties?fileIds={','.join(ids)}")
+    for i in range(n_tries):
+        try:
+            r = get_session().get(url, timeout=120)
+            r.raise_for_status()
+            text = r.text
+            return dict(re.findall(r'<mws:fileId>(.*?)</mws:fileId>.*?<mws:fileName>(.*?)</mws:fileName>', text, re.S))
+        except Exception:
+            if i < n_tries-1: sleep(min(wait*2**i, 60))
+    return {}
+
+def _granule_time(filename):
+    "Acquisition time from the `.A{year}{doy}.{HHMM}` part of a granule filename or `None` if not found."
+    x = re.search(r'^\w+.A(20[0-9][0-9])([0-3][0-9][0-9])(?:\.([0-2][0-9][0-5][0-9])\.)?', filename)
+    if x is None: return None
+    year, doy, hhmm = x.groups()
+    time = pd.Timestamp(f'{year}-01-01') + pd.Timedelta(days=int(doy)-1)
+    if hhmm is not None: time += pd.Timedelta(hours=int(hhmm[:2]), minutes=int(hhmm[2:]))
+    return time
+
+def _time_windows(tstart:str, tend:str, window:str):
+    """Split the time span from `tstart` to `tend` in consecutive windows of length `window`.
+    Anchored frequencies (e.g. 'MS' or 'W') start a window at each anchor, with a first partial window at `tstart`."""
+    tstart, tend = pd.Timestamp(tstart), pd.Timestamp(tend)
+    starts = pd.date_range(tstart, tend, freq=window)
+    starts = pd.DatetimeIndex([tstart]).append(starts[starts > tstart])
+    ends = [t - pd.Timedelta(seconds=1) for t in starts[1:]] + [tend]
+    return [(str(t0), str(t1)) for t0, t1 in zip(starts, ends)]
+
+def _split_by_day(ids:list, times:list, capacity:int, tstart:str, tend:str):
+    """Pack `ids` into the fewest groups of consecutive days with at most `capacity` files each.
+    Days with more than `capacity` files are split by acquisition time. Returns (ids, tstart, tend) groups."""
+    days, unknown = {}, []
+    for i, t in zip(ids, times):
+        if t is None: unknown.append(i)
+        else: days.setdefault(t.floor('D'), []).append((t, i))
+    units = []
+    for day in sorted(days):
+        granules = sorted(days[day])
+        if len(granules) <= capacity:
+            units.append(([i for _, i in granules], str(day), str(day + pd.Timedelta(days=1, seconds=-1))))
+        else:
+            for k in range(0, len(granules), capacity):
+                chunk = granules[k:k+capacity]
+                units.append(([i for _, i in chunk], str(chunk[0][0]), str(chunk[-1][0])))
+    # Files with unknown acquisition time can only be bounded by the full time span
+    units += [(unknown[k:k+capacity], tstart, tend) for k in range(0, len(unknown), capacity)]
+    groups = []
+    for unit_ids, unit_start, unit_end in units:
+        if len(groups) > 0 and len(groups[-1][0]) + len(unit_ids) <= capacity:
+            groups[-1] = (groups[-1][0] + unit_ids, groups[-1][1], unit_end)
+        else: groups.append((unit_ids, unit_start, unit_end))
+    return groups
+
 class Ladsweb():
     def __init__(self, product:str, collection:str, tstart:str, tend:str,
                  bbox:list, bands:list=None, coordsOrTiles:str="coords", daynight:str="DNB",
                  repName:str='GEO', repPixSize:float=0.01, repResample:str='bilinear',
-                 doMosaic:str='False', **kwargs):
+                 doMosaic:str='False', cache:DiskCache=None, index:GranuleIndex=None, ids:list=None,
+                 search_window:str=None, search_workers:int=8, archive_latency:str='3D', **kwargs):
         self.product, self.collection = product, collection
         self.tstart, self.tend, self.bbox, self.bands = tstart, tend, bbox, bands
         self.coordsOrTiles, self.daynight, self.repName = coordsOrTiles, daynight, repName
         self.repPixSize, self.repResample, self.doMosaic = repPixSize, repResample, doMosaic
         self._maxOrderSize, self._authFile = 1800, os.path.expanduser('~/.ladsweb')
+        # Set `cache=False` to always search online. Windows ending less than `archive_latency` ago are never
+        # cached since granules are still being published for them
+        self.cache = DiskCache(cache_path('ladsweb_search')) if cache is None else cache
+        self.archive_latency = archive_latency
+        self.index = GranuleIndex(cache_path('granules.db')) if index is None else index
+        # File ids of the order when already known, e.g. for the orders created by `split_times`
+        self.ids = ids
+        self.search_window, self.search_workers = search_window, search_workers
 
     @property
     def _email(self):
@@ -52,16 +172,67 @@ class Ladsweb():
         assert len(data) > 0
         return data
 
-    def search_files(self):
-        "Search for files for the product, region and time span given."
+    def _search(self, tstart, tend):
+        """Search for files between `tstart` and `tend` with a single request, unless the result is in the cache.
+        Only windows ending more than `archive_latency` ago are cached."""
+        key = [self.product, self.collection, tstart, tend, list(self.bbox),
+               self.coordsOrTiles, self.daynight]
+        now = pd.Timestamp.now('UTC').tz_localize(None)
+        cache = self.cache and pd.Timestamp(tend) < now - pd.Timedelta(self.archive_latency)
+        if cache:
+            ids = self.cache.get(key)
+            if ids is not None: return ids
         url = (f"https://modwebsrv.modaps.eosdis.nasa.gov/axis2/services/MODAPSservices/" +
             f"searchForFiles?product={self.product}&collection={self.collection}&" +
-            f"start={self.tstart}&stop={self.tend}&north={self.bbox[3]}&south={self.bbox[1]}" +
+            f"start={tstart}&stop={tend}&north={self.bbox[3]}&south={self.bbox[1]}" +
             f"&west={self.bbox[0]}&east={self.bbox[2]}&coordsOrTiles={self.coordsOrTiles}" +
             f"&dayNightBoth={self.daynight}")
-        return re.findall('<return>(.*?)</return>', requests.get(url).text)
+        ids = re.findall('<return>(.*?)</return>', get_session().get(url).text)
+        if cache and len(ids) > 0: self.cache.set(key, ids)
+        return ids
 
-    def download_raw_files(self, path_save:Path, replace=False):
+    def search_files(self):
+        """Search for files for the product, region and time span given. If `search_window` is defined
+        the time span is split in windows of that length (e.g. '30D') searched concurrently."""
+        if self.ids is not None: return self.ids
+        if self.search_window is None: return self._search(self.tstart, self.tend)
+        windows = _time_windows(self.tstart, self.tend, self.search_window)
+        with ThreadPoolExecutor(self.search_workers) as e:
+            results = list(e.map(lambda w: self._search(*w), windows))
+        # Files may be found in consecutive windows
+        return list(dict.fromkeys(i for ids in results for i in ids))
+
+    def search_filenames(self, ids:list, max_workers:int=16, n_tries:int=10, wait:float=1,
+                         batch_size:int=100, details:bool=True):
+        """Get the filenames for a list of ids obtained with `search_files`. Ids not in the index are looked up
+        in batches of `batch_size` with a pool of workers. With `details` the ids missing from the batch results
+        are looked up one by one in their details page, otherwise their filename is `None`."""
+        known = self.index.filenames(ids) if self.index else {}
+        unknown = [i for i in ids if i not in known]
+        batches = [unknown[k:k+batch_size] for k in range(0, len(unknown), batch_size)]
+        f = partial(_get_file_properties, n_tries=n_tries, wait=wait)
+        with ThreadPoolExecutor(max_workers) as e:
+            for found in progress_bar(e.map(f, batches), total=len(batches)): known.update(found)
+        missing = [i for i in unknown if i not in known]
+        f = partial(_get_filename, collection=self.collection, n_tries=n_tries, wait=wait)
+        if details and len(missing) > 0:
+            with ThreadPoolExecutor(max_workers) as e: known.update(zip(missing, e.map(f, missing)))
+        known.update({i: None for i in missing if i not in known})
+        if self.index:
+            self.index.add([{'filename': known[i], 'id': i, 'product': self.product,
+                             'collection': self.collection, 'time': _granule_time(known[i]),
+                             'bbox': self.bbox} for i in unknown if known[i] is not None])
+        filenames = [known[i] for i in ids]
+        failed = [i for i, fn in zip(ids, filenames) if fn is None]
+        if len(failed) > 0:
+            warnings.warn(f'Unable to get the filename for {len(failed)} ids: {",".join(failed)}', UserWarning)
+        return filenames
+
+    def local_files(self):
+        "DataFrame with the granules already downloaded for the product, region and time span given."
+        return self.index.query(self.bbox, self.tstart, self.tend, self.product)
+
+    def download_raw_files(self, path_save:Path, replace=False, max_workers:int=8, max_per_host:int=4):
         authFile = os.path.expanduser('~/.ladsweb')
         with open(authFile, 'r') as f:
             f = json.load(f)
@@ -77,81 +248,56 @@ class Ladsweb():
         order_ids = self.search_files()
 
         # Search filenames
-        filenames = []
-        for order_id in progress_bar(order_ids):
-            url = f'https://ladsweb.modaps.eosdis.nasa.gov/details/file/{self.collection}/{order_id}'
-            # Ladsweb will sometimes return 504 timeouts, so we retry up to 10 times
-            good_file = False
-            for _ in range(10):
-                if not good_file:
-                    try:
-                        file = re.findall('<td>File Name</td><td>(.*?)</td>', requests.get(url).text)[0]
-                        filenames.append(file)
-                        good_file = True
-                    except:
-                        warnings.warn(f'Unable to get {url} (most likely receieved 504 Gateway Time-out). Retrying.', UserWarning)
-                        sleep(10)
-
-        pattern = r'^\w+.A(20[0-9][0-9])([0-3][0-9][0-9])..*$'
-
-        # Extract time from filenames
-        times = []
-        for f in filenames:
-            x = re.search(pattern, f)
-            if x is not None:
-                year, doy = map(x.group, [1,2])
-            times.append(pd.Timestamp(f'{year}-01-01') + pd.Timedelta(days=int(doy)-1))
+        print('Searching for filenames...')
+        filenames = [f for f in self.search_filenames(order_ids) if f is not None]
 
         # Download Files
         print('Downloading files...')
-        for filename, time in progress_bar(zip(filenames, times), total=len(filenames)):
+        urls, files = [], []
+        for filename in filenames:
+            time = _granule_time(filename)
+            if time is None:
+                warnings.warn(f'Unable to get the acquisition time of {filename}', UserWarning)
+                continue
             year = time.year
             doy = time.dayofyear
             url = f'https://ladsweb.modaps.eosdis.nasa.gov/archive/allData/' \
                   f'{self.collection}/{self.product}/{year}/{doy:03d}/{filename}'
             fsave = f'{path_save/filename}'
             if not Path(fsave).is_file() or replace:
-                good_file = False
-                for _ in range(10):
-                    if not good_file:
-                        with open(fsave, mode='w+b') as fh:
-                            try:
-                                geturl(f'{url}', auth, fh)
-                            except Exception as e:
-                                warnings.warn(f'Unable to get {url}. Exception {e}', UserWarning)
-                        try:
-                            Dataset(fsave, mode='r')
-                            good_file = True
-                        except:
-                            warnings.warn(f'Failed to open netcdf. Trying to download again.')
-                            os.remove(fsave)
-                            sleep(10)
+                urls.append(url)
+                files.append(fsave)
             else: warnings.warn(f'{filename} already exists in {path_save} and replace is set to False')
-
-    def order_size(self):
-        "Calculates the number of files in the order."
+        failed = download_parallel(urls, files, auth, validate=_validate_netcdf,
+                                   max_workers=max_workers, max_per_host=max_per_host)
+        if self.index:
+            self.index.add([{'filename': f, 'path': str(path_save/f), 'size': os.path.getsize(path_save/f)}
+                            for f in filenames if str(path_save/f) not in failed and (path_save/f).is_file()])
+        if len(failed) > 0:
+            warnings.warn(f'Failed to download {len(failed)} files: {", ".join(failed)}', UserWarning)
+        return failed
+
+    def order_size(self, ids:list=None):
+        "Calculates the number of files in the order, from the `ids` found by `search_files` if given."
         if self.bands is None:
             raise Exception("`bands` list required to calculate order_size.")
-        return len(self.search_files())*len(self.bands)
+        if ids is None: ids = self.search_files()
+        return len(ids)*len(self.bands)
 
     def split_times(self, maxOrderSize=None):
-        "Split a single order into multiple orders if the order size is too large."
+        """Split a single order into multiple orders if the order size is too large. The files found
+        are packed by acquisition day into the fewest orders within `maxOrderSize`. Acquisition times come
+        from the index or batched file properties requests; files without one are bounded by the full span."""
         if maxOrderSize is None: maxOrderSize = self._maxOrderSize
-        order_size = self.order_size()
-        if order_size <= maxOrderSize:
+        ids = self.search_files()
+        if self.order_size(ids) <= maxOrderSize:
             return [self]
-        n_splits = order_size // maxOrderSize + 1
-        times = pd.date_range(self.tstart, self.tend)
-        bk = -(len(times) % n_splits)
-        if bk == 0: bk = None
-        splits = np.split(times[:bk], n_splits)
-        splits[-1] = splits[-1].append(times[bk:])
-        times = [(str(t[0]), str(t[-1]+pd.Timedelta(days=1-1e-5).round('s'))) for t in splits]
-        tstart, tend = zip(*times)
-        kwargs = self.__dict__
+        times = [None if f is None else _granule_time(f) for f in self.search_filenames(ids, details=False)]
+        capacity = max(maxOrderSize // len(self.bands), 1)
+        kwargs = dict(self.__dict__)
         group = []
-        for ti, tf in zip(tstart, tend):
-            kwargs['tstart'], kwargs['tend'] = ti, tf
+        for group_ids, tstart, tend in _split_by_day(ids, times, capacity, self.tstart, self.tend):
+            kwargs['tstart'], kwargs['tend'], kwargs['ids'] = tstart, tend, group_ids
             group.append(Ladsweb(**kwargs))
         return group
 
@@ -171,7 +317,7 @@ class Ladsweb():
             f"&reprojectionResampleType={self.repResample}" +
             f"&doMosaic={self.doMosaic}" +
             f"&email={self._email}")
-        return re.findall('<return>(.*?)</return>', requests.get(url).text)[0]
+        return re.findall('<return>(.*?)</return>', get_session().get(url).text)[0]
 
     def run(self, path_save):
         "Send request and update log file."
@@ -184,6 +330,7 @@ class Ladsweb():
         status = order_status(orderId)
         update_log(Path(path_save)/'order_log.json', orderId, status)
         print(f'New request sent with orderId {orderId}')
+        return orderId
 
     def __repr__(self):
         s = ''
@@ -192,38 +339,88 @@ class Ladsweb():
         return s + '\n'
 
 # Cell
+class OrderJournal():
+    "SQLite journal with the status of each order and the time of its last change, updated atomically per order."
+    def __init__(self, file):
+        self.file = Path(file)
+        con = self._connect()
+        try:
+            with con:
+                con.execute('PRAGMA journal_mode=WAL')
+                con.execute('CREATE TABLE IF NOT EXISTS orders (orderId TEXT PRIMARY KEY, status TEXT, time TEXT)')
+        finally: con.close()
+
+    def _connect(self):
+        return sqlite3.connect(str(self.file), timeout=60)
+
+    def update(self, orderId, status, time=None):
+        "Set the status of `orderId`. The time is only updated if the status changes."
+        if time is None: time = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        con = self._connect()
+        try:
+            with con:
+                con.execute("INSERT OR IGNORE INTO orders VALUES (?, '', '')", (orderId,))
+                con.execute('UPDATE orders SET status=?, time=? WHERE orderId=? AND status!=?',
+                            (status, time, orderId, status))
+        finally: con.close()
+
+    def read(self):
+        "Dict with the status and time of each order, in the order they were added."
+        con = self._connect()
+        try: rows = con.execute('SELECT orderId, status, time FROM orders ORDER BY rowid').fetchall()
+        finally: con.close()
+        return {o: {'status': s, 'time': t} for o, s, t in rows}
+
+    def load(self, data:dict):
+        "Add the orders of a dict in the format returned by `read` that are not in the journal yet."
+        con = self._connect()
+        try:
+            with con:
+                con.executemany('INSERT OR IGNORE INTO orders VALUES (?, ?, ?)',
+                                [(o, v['status'], v['time']) for o, v in data.items()])
+        finally: con.close()
+
+def _journal(file):
+    "Journal for the log `file`, saved next to it with .db suffix. Existing json logs are imported once."
+    file = Path(file)
+    exists = file.with_suffix('.db').is_file()
+    journal = OrderJournal(file.with_suffix('.db'))
+    if not exists and file.suffix == '.json' and file.is_file():
+        with open(file, 'r') as f:
+            journal.load(json.load(f))
+    return journal
+
 def read_log(file):
     "Read log file."
-    with open(file, 'r') as f:
-        data = json.load(f)
-    return data
+    return _journal(file).read()
 
 def update_log(file, orderId, status):
     "Update log file."
-    now = datetime.now()
-    current_time = now.strftime("%Y-%m-%d_%H:%M:%S")
-    if file.is_file():
-        stored_data = read_log(file)
-        if orderId not in [k for k in stored_data]:
-            stored_data[orderId] = {'status': '', 'time': ''}
-        if stored_data[orderId]['status'] != status:
-            stored_data[orderId]['status'] = status
-            stored_data[orderId]['time'] = current_time
-    else:
-        stored_data = {orderId: {'status': status, 'time': current_time}}
-
-    with open(file, 'w') as f:
-        json.dump(stored_data, f)
+    _journal(file).update(orderId, status)
 
 def order_status(orderId):
     "Check order status."
     url = (f"http://modwebsrv.modaps.eosdis.nasa.gov/axis2/services/MODAPSservices/" +
             f"getOrderStatus?orderId={orderId}")
-    return re.findall('<return>(.*?)</return>', requests.get(url).text)[0]
-
-def download_files(orderId, path_save, auth=None):
-    "Download files if the order is Available."
+    return re.findall('<return>(.*?)</return>', get_session().get(url).text)[0]
+
+def _download_verified(url, file, checksum, auth, n_tries:int=5):
+    "Download `url` to `file` until the cksum computed while downloading matches `checksum`."
+    csum = None
+    for _ in range(n_tries):
+        hasher = Cksum()
+        if not download_url(url, file, auth, hasher=hasher):
+            warnings.warn(f'Unable to get {url}', UserWarning)
+            continue
+        csum = str(hasher.value)
+        if checksum is None: checksum = csum
+        if checksum == csum: return csum, True
+    return csum, False
+
+def download_files(orderId, path_save, auth=None, max_workers:int=8, index:GranuleIndex=None):
+    "Download files if the order is Available, using `max_workers` parallel downloads."
     if auth is None: raise Exception("`auth` code is not defined")
+    if index is None: index = GranuleIndex(cache_path('granules.db'))
     status = order_status(orderId)
     if status != 'Available':
         msg = f"Order is not Available, current status is {status}"
@@ -233,32 +430,33 @@ def download_files(orderId, path_save, auth=None):
     #files = pd.DataFrame(json.loads(geturl(url + '.json', auth))) # no longer available
     checksums = geturl(url + f'/checksums_{orderId}', auth)
     hdfs = re.findall('(.*?.hdf)', checksums)
-    ch = [tuple([k for k in h.split(' ') if k != '']) for h in hdfs]
-    files = pd.DataFrame(ch, columns=['checksum', 'size', 'name'])
-    files = files.drop('size', axis=1)
-    #files = pd.merge(files, check_df, how='left', on='name')
-    files['verified'] = False
-
-    for i in progress_bar(range(len(files))):
-        file, checksum = files.loc[i, ['name', 'checksum']]
-        csum = None
-        if (Path(path_save)/file).is_file():
-            csum = os.popen(f'cksum {str(path_save)}/{file}').read().split(' ')[0]
-        if csum is None or checksum != csum:
-            n_tries = 0
-            while ~files.loc[i, 'verified'] and n_tries<5:
-                #print(f'Downloading {file}')
-                with open(Path(path_save)/f'{file}', mode='w+b') as fh:
-                    try: geturl(f'{url}/{file}', auth, fh)
-                    except: warnings.warn(f'Unable to get {url}/{file}', UserWarning)
-                csum = os.popen(f'cksum {str(path_save)}/{file}').read().split(' ')[0]
-                if str(checksum) == 'nan': checksum = csum
-                files.loc[i, 'verified'] = checksum == csum
-                n_tries += 1
-        elif checksum == csum: files.loc[i, 'verified'] = True
+    # (checksum, size, name) for each file
+    manifest = [tuple([k for k in h.split(' ') if k != '']) for h in hdfs]
+
+    def _process(row):
+        checksum, _, name = row
+        file = Path(path_save)/name
+        if file.is_file():
+            # Files already present are verified first, using the checksum in the index if the file didn't change
+            known = index.get(name) if index else None
+            if (known is not None and known['path'] == str(file) and known['size'] == file.stat().st_size
+                and known['cksum'] is not None): csum = known['cksum']
+            else: csum = str(cksum(file))
+            if csum == checksum: return csum, True
+        return _download_verified(f'{url}/{name}', file, checksum, auth)
+
+    with ThreadPoolExecutor(max_workers) as e:
+        results = list(progress_bar(e.map(_process, manifest), total=len(manifest)))
+
+    if index:
+        index.add([{'filename': name, 'product': name.split('.')[0], 'time': _granule_time(name),
+                    'path': str(Path(path_save)/name), 'size': (Path(path_save)/name).stat().st_size,
+                    'cksum': csum} for (_, _, name), (csum, verified) in zip(manifest, results) if verified])
     log_file = f'download_log_{orderId}.csv'
+    files = pd.DataFrame([(checksum, name, verified) for (checksum, _, name), (_, verified) in zip(manifest, results)],
+                         columns=['checksum', 'name', 'verified'])
     files.to_csv(Path(path_save)/log_file)
-    not_verified = np.sum(~files.verified)
+    not_verified = int(np.sum(~files.verified))
     if not_verified > 0:
         msg = f"Checksum failed for {not_verified} files. Check the {log_file}."
         warnings.warn(msg, UserWarning)
@@ -269,55 +467,133 @@ def release_order(orderId, email=None):
     if email is None: raise Exception("`email` is not defined")
     url = (f"http://modwebsrv.modaps.eosdis.nasa.gov/axis2/services/MODAPSservices/" +
     f"releaseOrder?orderId={orderId}&email={email}")
-    status = re.findall('<return>(.*?)</return>', requests.get(url).text)[0]
+    status = re.findall('<return>(.*?)</return>', get_session().get(url).text)[0]
     return status == '1'
 
-def order_manager(path_save):
-    "Manage active orders in log file. Check the status and download the files for each order"
-    authFile = os.path.expanduser('~/.ladsweb')
-    with open(authFile, 'r') as f:
+_final_status = ['Complete', 'One or more files not verified', 'Canceled', 'Removed']
+# Seconds between status polls right after an order enters each state
+_poll_interval = {'New': 120, 'Queued': 120, 'Running': 60, 'Available': 20}
+
+def _read_auth(authFile='~/.ladsweb'):
+    with open(os.path.expanduser(authFile), 'r') as f:
         f = json.load(f)
-        email = f['email']
-        auth = f['key']
-
-    log_file = Path(path_save)/'order_log.json'
-    while True:
-        data = read_log(log_file)
-
-        # Update status
-        for orderId in data:
-            if data[orderId]['status'] != 'Complete':
-                status = order_status(orderId)
-                update_log(log_file, orderId, status)
-
-        # Download if available (wait 10 min)
-        now = datetime.now()
-        current_time = now.strftime("%Y%m%d_%H%M%S")
-        for orderId in data:
-            if data[orderId]['status'] == 'Available':
-                d = (pd.Timestamp(' '.join(current_time.split('_')))
-                     - pd.Timestamp(' '.join(data[orderId]['time'].split('_')))).seconds
-                if d//60 > 10:
-                    status = download_files(orderId, path_save, auth)
-                    if status == 0:
-                        result = release_order(orderId, email)
+    return f['email'], f['key']
+
+class OrderManager():
+    """Tracks orders concurrently with asyncio. The status of each order is polled with a backoff
+    that depends on its state, files are downloaded once it's Available and the order is released
+    as soon as all files are verified. At most `max_downloads` orders are downloaded at once."""
+    def __init__(self, path_save, max_downloads:int=2, max_polls:int=16, available_delay:float=600,
+                 max_interval:float=600, authFile:str='~/.ladsweb'):
+        self.path_save = Path(path_save)
+        self.journal = _journal(self.path_save/'order_log.json')
+        self.max_downloads, self.max_polls = max_downloads, max_polls
+        self.available_delay, self.max_interval = available_delay, max_interval
+        self.email, self.auth = _read_auth(authFile)
+        self._tasks, self._executor, self._downloads = {}, None, None
+
+    def _setup(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_polls + self.max_downloads)
+            self._downloads = asyncio.Semaphore(self.max_downloads)
+
+    async def _call(self, f, *args):
+        "Run the blocking function `f` in the thread pool."
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(f, *args))
+
+    async def track(self, orderId):
+        "Poll the status of `orderId` until it's Available, then download the files and release it."
+        status, interval = None, 0
+        while True:
+            try: new_status = await self._call(order_status, orderId)
+            except Exception as e:
+                warnings.warn(f'Unable to get the status of order {orderId}. Exception {e}', UserWarning)
+                new_status = status
+            # Unknown or unchanged status backs off from at least the interval of its state
+            if new_status != status: interval = _poll_interval.get(new_status, 60)
+            else: interval = min(max(interval*1.5, _poll_interval.get(status, 60)), self.max_interval)
+            status = new_status
+            if status is not None: self.journal.update(orderId, status)
+            if status in _final_status: return status
+
+            if status == 'Available':
+                # Wait `available_delay` seconds after the order became Available
+                available_time = self.journal.read()[orderId]['time']
+                elapsed = (datetime.now() - datetime.strptime(available_time, "%Y-%m-%d_%H:%M:%S")).total_seconds()
+                if elapsed < self.available_delay: await asyncio.sleep(self.available_delay - elapsed)
+                # Failed downloads or releases are retried on the next poll
+                try:
+                    async with self._downloads:
+                        not_verified = await self._call(download_files, orderId, self.path_save, self.auth)
+                    if not_verified == 0:
+                        result = await self._call(release_order, orderId, self.email)
                         status = 'Complete' if result else 'One or more files not verified'
-                        update_log(log_file, orderId, status)
-                        print(f'Files for order {orderId} saved at {path_save}.')
-
-        # Check if stop
-        n = 0
-        for orderId in data:
-            if data[orderId]['status'] in ['Complete', 'One or more files not verified',
-                                           'Canceled', 'Removed']:
-                n += 1
-        stop = len(data) == n
-        if stop: return
-        sleep(20)
-
-def run_all(request_list, path_save):
-    "Send a list of requests and initiate order manager."
-    for request in request_list:
-        request.run(path_save)
-        sleep(5)
-    order_manager(path_save)
\ No newline at end of file
+                        self.journal.update(orderId, status)
+                        print(f'Files for order {orderId} saved at {self.path_save}.')
+                        return status
+                except Exception as e:
+                    warnings.warn(f'Unable to download or release order {orderId}. Exception {e}', UserWarning)
+            await asyncio.sleep(interval)
+
+    def add(self, orderId):
+        "Start tracking `orderId`. Must be called with the event loop running."
+        self._setup()
+        if orderId not in self._tasks:
+            self._tasks[orderId] = asyncio.ensure_future(self.track(orderId))
+
+    async def run(self, orderIds:list=None):
+        "Track `orderIds`, or else all active orders in the log file, and wait for all orders being tracked."
+        if orderIds is None:
+            orderIds = [o for o, v in self.journal.read().items() if v['status'] not in _final_status]
+        for orderId in orderIds: self.add(orderId)
+        try:
+            # Orders may be added while waiting
+            while not all(t.done() for t in self._tasks.values()):
+                await asyncio.wait(list(self._tasks.values()))
+        finally:
+            if self._executor is not None: self._executor.shutdown(wait=False)
+            self._executor = None
+        return {o: t.result() for o, t in self._tasks.items()}
+
+def _run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try: return loop.run_until_complete(coroutine)
+    finally: loop.close()
+
+def order_manager(path_save, max_downloads:int=2, available_delay:float=600):
+    "Manage active orders in log file. Check the status and download the files for each order"
+    manager = OrderManager(path_save, max_downloads=max_downloads, available_delay=available_delay)
+    return _run_async(manager.run())
+
+class _RateLimiter():
+    "Spaces the calls to `wait` by at least `min_interval` seconds."
+    def __init__(self, min_interval:float):
+        self.min_interval, self._next = min_interval, 0
+
+    async def wait(self):
+        now = asyncio.get_event_loop().time()
+        start = max(now, self._next)
+        self._next = start + self.min_interval
+        if start > now: await asyncio.sleep(start - now)
+
+def run_all(request_list, path_save, max_submit:int=2, min_interval:float=5, max_downloads:int=2,
+            available_delay:float=600):
+    """Send a list of requests and initiate order manager. Up to `max_submit` requests are searched and
+    submitted at once, `min_interval` seconds apart, and each order is tracked as soon as it's submitted."""
+    manager = OrderManager(path_save, max_downloads=max_downloads, available_delay=available_delay)
+
+    async def _run():
+        manager._setup()
+        limiter, submissions = _RateLimiter(min_interval), asyncio.Semaphore(max_submit)
+        async def _submit(request):
+            async with submissions:
+                await limiter.wait()
+                try: orderId = await manager._call(request.run, path_save)
+                except Exception as e:
+                    warnings.warn(f'Unable to send request {request}. Exception {e}', UserWarning)
+                    return
+            if orderId is not None: manager.add(orderId)
+        await asyncio.gather(*[_submit(request) for request in request_list])
+        return await manager.run()
+
+    return _run_async(_run())
\ No newline at end of file
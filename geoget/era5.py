@@ -1,33 +1,50 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_era5.ipynb (unless otherwise specified).
 
-__all__ = ['get_config', 'send_request', 'fwi_set', 'era5_get_year', 'era5land_get']
+__all__ = ['get_config', 'get_client', 'send_request', 'fwi_set', 'era5_get_year', 'count_fields', 'plan_requests',
+           'era5land_get', 'ERA5Store', 'ERA5_SHORT_NAMES', 'era5_merge', 'era5_read']
 
 # Cell
+import os
+import json
+import hashlib
+import sqlite3
+import threading
 import cdsapi
-from netCDF4 import Dataset
+from netCDF4 import Dataset, num2date
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from .geo import RegionST
 from concurrent.futures import ThreadPoolExecutor
+from itertools import product as iproduct
 from tqdm import tqdm
-from functools import partial
 from pathlib import Path
 
 # Cell
-def get_config(region:RegionST, variables:list, year:int):
-    months = region.times[region.times.year==year].strftime('%m').unique().values.tolist()
-    days = region.times[region.times.year==year].strftime('%d').unique().values.tolist()
-    times = region.times[region.times.year==year].strftime('%H:%M').unique().tolist()
+def get_config(region:RegionST, variables:list, year:int, month:int=None):
+    times = region.times[region.times.year==year]
+    if month is not None: times = times[times.month==month]
+    months = times.strftime('%m').unique().values.tolist()
+    days = times.strftime('%d').unique().values.tolist()
+    times = times.strftime('%H:%M').unique().tolist()
     bbox = [region.bbox.top, region.bbox.left, region.bbox.bottom, region.bbox.right]
     config = {'format': 'netcdf', 'variable': variables, 'year': [str(year)],
               'month': months, 'day': days, 'time': times,
               'area': f'{"/".join([str(s) for s in bbox])}'} # North, West, South, East
     return config
 
+_clients = threading.local()
+
+def get_client():
+    "Returns the `cdsapi.Client` of the current thread, so workers reuse their client across requests."
+    if getattr(_clients, 'client', None) is None: _clients.client = cdsapi.Client()
+    return _clients.client
+
 def send_request(product:str, config:dict, filename:str):
-    c = cdsapi.Client()
+    "Retrieves `config` from `product` to `filename` through a `.part` file so only complete files are kept."
     print('Sending request')
-    c.retrieve(product, config, filename)
+    get_client().retrieve(product, config, f'{filename}.part')
+    os.replace(f'{filename}.part', filename)
 
 def fwi_set():
     return ['10m_u_component_of_wind', '10m_v_component_of_wind', '2m_dewpoint_temperature',
@@ -38,10 +55,309 @@ def era5_get_year(year, region, save_path, variables, product):
     filename = save_path/f'{product}_{region.name}_{year}.nc'
     r = send_request(product, config, str(filename))
 
+def count_fields(config:dict):
+    "Number of fields (variables x dates x times) requested by `config`, as counted by the CDS limits."
+    return int(np.prod([len(config[k]) for k in ['variable', 'year', 'month', 'day', 'time']]))
+
+def plan_requests(region:RegionST, save_path, variables:list=fwi_set(), product:str='reanalysis-era5-land',
+                  max_fields:int=12000):
+    """Splits the download of `region` into requests of at most `max_fields` fields.
+    Each year is a single request if it fits, otherwise it is split by month and then by groups of variables.
+    Returns a list of `(config, filename)`."""
+    save_path = Path(save_path)
+    plan = []
+    for year in region.times.year.unique().values:
+        config = get_config(region, variables, year)
+        if count_fields(config) <= max_fields:
+            plan.append((config, save_path/f'{product}_{region.name}_{year}.nc'))
+            continue
+        for month in region.times[region.times.year==year].month.unique().values:
+            config = get_config(region, variables, year, month)
+            group = max(1, max_fields//count_fields({**config, 'variable': [0]}))
+            groups = [variables[i:i+group] for i in range(0, len(variables), group)]
+            for i, group in enumerate(groups):
+                suffix = '' if len(groups) == 1 else f'_{i}'
+                plan.append((get_config(region, group, year, month),
+                             save_path/f'{product}_{region.name}_{year}{month:02d}{suffix}.nc'))
+    return plan
+
+def _valid_netcdf(file):
+    "Returns True if `file` exists and can be opened as a netcdf file."
+    try: Dataset(file).close()
+    except (OSError, RuntimeError): return False
+    return True
+
 def era5land_get(region, save_path, variables=fwi_set(), product='reanalysis-era5-land',
-                 max_workers=8):
-    f = partial(era5_get_year, region=region, save_path=save_path, variables=variables,
-                product=product)
-    years = region.times.year.unique().values
+                 max_workers=8, max_fields:int=12000, merge_file=None):
+    """Downloads `variables` of `product` for `region` to `save_path` with `max_workers` requests at a time.
+    The download is split by `plan_requests` and requests whose file already holds the requested variables,
+    times and area are skipped.
+    If `merge_file` is given the downloaded files are merged into it with `era5_merge`."""
+    Path(save_path).mkdir(exist_ok=True, parents=True)
+    plan = plan_requests(region, save_path, variables, product, max_fields)
+    todo = [(config, file) for config, file in plan if not _covers(file, config)]
+    f = lambda o: send_request(product, o[0], str(o[1]))
     with ThreadPoolExecutor(max_workers) as e:
-        list(tqdm(e.map(f, years), total=len(years)))
\ No newline at end of file
+        list(tqdm(e.map(f, todo), total=len(todo)))
+    if merge_file is not None: era5_merge([file for _, file in plan], merge_file)
+
+# Cell
+# netcdf names of the CDS variables, used when a file holds more than one variable
+ERA5_SHORT_NAMES = {'10m_u_component_of_wind': 'u10', '10m_v_component_of_wind': 'v10',
+                    '2m_dewpoint_temperature': 'd2m', '2m_temperature': 't2m', 'surface_pressure': 'sp',
+                    'total_precipitation': 'tp', 'skin_temperature': 'skt', 'surface_solar_radiation_downwards': 'ssrd',
+                    'volumetric_soil_water_layer_1': 'swvl1', 'leaf_area_index_high_vegetation': 'lai_hv',
+                    'leaf_area_index_low_vegetation': 'lai_lv', 'snow_cover': 'snowc', 'evaporation': 'e'}
+
+def _area(config:dict):
+    "North, west, south and east bounds of the `area` of `config`."
+    return [float(o) for o in config['area'].split('/')]
+
+def _nc_name(nc, variable:str):
+    "Name of `variable` in the netcdf file `nc`."
+    if variable in nc.variables: return variable
+    if ERA5_SHORT_NAMES.get(variable) in nc.variables: return ERA5_SHORT_NAMES[variable]
+    names = [k for k, v in nc.variables.items() if len(v.dimensions) >= 3]
+    if len(names) == 1: return names[0]
+    raise KeyError(f'{variable} not found in {nc.filepath()}, add its short name to ERA5_SHORT_NAMES')
+
+def _nc_coord(nc, names:list):
+    return nc[[n for n in names if n in nc.variables][0]]
+
+def _nc_times(nc):
+    t = _nc_coord(nc, ['valid_time', 'time'])
+    return pd.DatetimeIndex(num2date(t[:], t.units, only_use_cftime_datetimes=False,
+                                     only_use_python_datetimes=True))
+
+def _read_field(var, itime, ilat, ilon):
+    """Reads `var` at the `itime`, `ilat` and `ilon` indices. Files mixing ERA5 and ERA5T data have an
+    `expver` dimension where each time is only valid in one version, so the versions are combined."""
+    if 'expver' not in var.dimensions: return var[itime, ilat, ilon]
+    index = [itime, ilat, ilon]
+    index.insert(var.dimensions.index('expver'), slice(None))
+    data = np.ma.masked_invalid(np.moveaxis(np.ma.asarray(var[tuple(index)]), var.dimensions.index('expver'), 0))
+    out = data[0]
+    for version in data[1:]: out = np.ma.where(np.ma.getmaskarray(out), version, out)
+    return out
+
+def _config_times(config:dict):
+    "Times requested by `config` (CDS requests are the product of years, months, days and times)."
+    times = []
+    for y, m, d, t in iproduct(config['year'], config['month'], config['day'], config['time']):
+        try: times.append(pd.Timestamp(f'{y}-{m}-{d} {t}'))
+        except ValueError: pass # e.g. 31 of February
+    return pd.DatetimeIndex(sorted(times))
+
+def _covers(file, config:dict):
+    "True if the netcdf `file` holds all the variables, times and area requested by `config`."
+    try:
+        with Dataset(file) as nc:
+            if any(v not in nc.variables and ERA5_SHORT_NAMES.get(v) not in nc.variables for v in config['variable']):
+                return False
+            if not _config_times(config).isin(_nc_times(nc)).all(): return False
+            north, west, south, east = _area(config)
+            for coord, low, high in [(['latitude', 'lat'], south, north), (['longitude', 'lon'], west, east)]:
+                x = _nc_coord(nc, coord)[:]
+                step = np.abs(np.diff(x)).max() if len(x) > 1 else 0
+                # CDS snaps the area to its grid, so the bounds may differ by up to one cell
+                if x.min() < low-step-1e-6 or x.max() > high+step+1e-6: return False
+                if x.min() > low+step+1e-6 or x.max() < high-step-1e-6: return False
+    except (OSError, RuntimeError, KeyError, IndexError, ValueError): return False
+    return True
+
+class ERA5Store():
+    """Content addressed store of ERA5 downloads in `path` with a SQLite manifest of the variables,
+    area and times retrieved in each file. Requests covered by previous downloads, even of larger areas
+    or more variables, are answered by slicing the stored files and only the missing variables and months
+    are requested to the CDS."""
+    _columns = ['file', 'product', 'variables', 'year', 'months', 'days', 'times',
+                'north', 'west', 'south', 'east']
+
+    def __init__(self, path):
+        self.path = Path(path)
+        (self.path/'data').mkdir(exist_ok=True, parents=True)
+        self.file = self.path/'manifest.db'
+        self._execute('CREATE TABLE IF NOT EXISTS era5 (file TEXT PRIMARY KEY, product TEXT, variables TEXT, '
+                      'year INTEGER, months TEXT, days TEXT, times TEXT, '
+                      'north REAL, west REAL, south REAL, east REAL)')
+
+    def _execute(self, sql, params=()):
+        con = sqlite3.connect(str(self.file), timeout=60)
+        try:
+            with con: return con.execute(sql, params).fetchall()
+        finally: con.close()
+
+    def add(self, product:str, config:dict, file):
+        "Records that `file` holds the data of `config` for `product`."
+        self._execute(f'INSERT OR REPLACE INTO era5 ({", ".join(self._columns)}) VALUES ({",".join("?"*11)})',
+                      [Path(file).name, product, json.dumps(config['variable']), int(config['year'][0]),
+                       json.dumps(config['month']), json.dumps(config['day']), json.dumps(config['time']),
+                       *_area(config)])
+
+    def find(self, product:str, config:dict):
+        "Path of a stored file with all the variables, times and area of `config` or `None`."
+        north, west, south, east = _area(config)
+        rows = self._execute('SELECT file, variables, months, days, times FROM era5 WHERE product=? AND year=? '
+                             'AND north>=? AND west<=? AND south<=? AND east>=? '
+                             'ORDER BY (north-south)*(east-west)',
+                             (product, int(config['year'][0]), north, west, south, east))
+        for file, *values in rows:
+            variables, months, days, times = map(json.loads, values)
+            if not (set(config['variable']) <= set(variables) and set(config['month']) <= set(months) and
+                    set(config['day']) <= set(days) and set(config['time']) <= set(times)): continue
+            if _valid_netcdf(self.path/'data'/file): return self.path/'data'/file
+        return None
+
+    def retrieve(self, product:str, config:dict):
+        "Downloads `config` to the store, named by the hash of the request, and returns the file."
+        h = hashlib.sha1(json.dumps([product, config], sort_keys=True).encode()).hexdigest()
+        file = self.path/'data'/f'{h}.nc'
+        if not _valid_netcdf(file): send_request(product, config, str(file))
+        self.add(product, config, file)
+        return file
+
+    def _missing_requests(self, region, missing, max_fields):
+        "Requests for the `missing` variables of each (year, month), by year when all months miss the same ones."
+        requests = []
+        for year in region.times.year.unique().values:
+            months = region.times[region.times.year==year].month.unique().values
+            if not any((year, m) in missing for m in months): continue
+            variables = missing.get((year, months[0]))
+            if all(missing.get((year, m)) == variables for m in months):
+                config = get_config(region, variables, year)
+                if count_fields(config) <= max_fields:
+                    requests.append(config)
+                    continue
+            for m in months:
+                if (year, m) not in missing: continue
+                variables = missing[(year, m)]
+                group = max(1, max_fields//count_fields({**get_config(region, variables, year, m), 'variable': [0]}))
+                requests += [get_config(region, variables[i:i+group], year, m) for i in range(0, len(variables), group)]
+        return requests
+
+    def get(self, region:RegionST, save_path, variables:list=fwi_set(), product:str='reanalysis-era5-land',
+            max_workers:int=8, max_fields:int=12000):
+        """Writes `variables` of `product` for `region` to `save_path` with one file per year named as in
+        `era5land_get`. Returns the list of files."""
+        save_path = Path(save_path)
+        save_path.mkdir(exist_ok=True, parents=True)
+        sources, missing = {}, {}
+        for year in region.times.year.unique().values:
+            for month in region.times[region.times.year==year].month.unique().values:
+                config = get_config(region, variables, year, month)
+                for v in variables:
+                    file = self.find(product, {**config, 'variable': [v]})
+                    if file is None: missing.setdefault((year, month), []).append(v)
+                    else: sources[(year, month, v)] = file
+        requests = self._missing_requests(region, missing, max_fields)
+        if len(requests) > 0:
+            print(f'{len(sources)} of {len(sources)+sum(map(len, missing.values()))} variable-months found locally, '
+                  f'sending {len(requests)} requests')
+        with ThreadPoolExecutor(max_workers) as e:
+            files = list(tqdm(e.map(lambda config: self.retrieve(product, config), requests), total=len(requests)))
+        for config, file in zip(requests, files):
+            for m in config['month']:
+                for v in config['variable']: sources[(int(config['year'][0]), int(m), v)] = file
+        out = []
+        for year in region.times.year.unique().values:
+            filename = save_path/f'{product}_{region.name}_{year}.nc'
+            self._write(filename, region.times[region.times.year==year], variables,
+                        {(m, v): f for (y, m, v), f in sources.items() if y == year}, region.bbox)
+            out.append(filename)
+        return out
+
+    def _write(self, filename, times, variables, sources, bbox):
+        "Writes `variables` at `times` inside `bbox` to `filename` slicing the files in `sources[(month, variable)]`."
+        def window(nc):
+            lat, lon = _nc_coord(nc, ['latitude', 'lat'])[:], _nc_coord(nc, ['longitude', 'lon'])[:]
+            ilat = np.where((lat >= bbox.bottom-1e-4) & (lat <= bbox.top+1e-4))[0]
+            ilon = np.where((lon >= bbox.left-1e-4) & (lon <= bbox.right+1e-4))[0]
+            return slice(ilat[0], ilat[-1]+1), slice(ilon[0], ilon[-1]+1)
+        with Dataset(f'{filename}.part', 'w') as dst:
+            for (month, variable), file in sorted(sources.items()):
+                with Dataset(file) as src:
+                    ilat, ilon = window(src)
+                    name = _nc_name(src, variable)
+                    if len(dst.dimensions) == 0:
+                        lat, lon = _nc_coord(src, ['latitude', 'lat']), _nc_coord(src, ['longitude', 'lon'])
+                        dst.createDimension('time', len(times))
+                        dst.createDimension('latitude', ilat.stop-ilat.start)
+                        dst.createDimension('longitude', ilon.stop-ilon.start)
+                        t = dst.createVariable('time', 'i4', ('time',))
+                        t.units, t.calendar = 'hours since 1900-01-01 00:00:00', 'gregorian'
+                        t[:] = (times - pd.Timestamp('1900-01-01'))//pd.Timedelta(hours=1)
+                        for out, coord, idx in [('latitude', lat, ilat), ('longitude', lon, ilon)]:
+                            dst.createVariable(out, 'f4', (out,))
+                            dst[out][:], dst[out].units = coord[idx], coord.units
+                    if name not in dst.variables:
+                        var = dst.createVariable(name, 'f4', ('time', 'latitude', 'longitude'), zlib=True,
+                                                 fill_value=np.float32(-32767))
+                        var.setncatts({k: src[name].getncattr(k) for k in ['units', 'long_name']
+                                       if k in src[name].ncattrs()})
+                    src_times = _nc_times(src)
+                    month_times = times[times.month == month]
+                    itime = src_times.get_indexer(month_times)
+                    if (itime < 0).any(): raise ValueError(f'{file} does not have all the times of {variable}')
+                    data = _read_field(src[name], itime, ilat, ilon)
+                    dst[name][times.get_indexer(month_times)] = data
+        os.replace(f'{filename}.part', filename)
+
+# Cell
+def era5_merge(files:list, file, chunks:tuple=(24*31, 32, 32), block:int=24*31):
+    """Merges the netcdf `files` downloaded by `era5land_get` or `ERA5Store.get` into a single compressed
+    netcdf4 `file` along time, with chunks of `chunks` (time, latitude, longitude) sizes.
+    Files can hold different variables of the same times (requests split by variable groups).
+    The data is copied `block` time steps at a time to keep memory flat."""
+    index = {}
+    for f in files:
+        with Dataset(f) as nc: index[f] = _nc_times(nc)
+    times = pd.DatetimeIndex(sorted(set().union(*index.values())))
+    with Dataset(f'{file}.part', 'w') as dst:
+        for f in sorted(files, key=lambda f: index[f][0]):
+            with Dataset(f) as src:
+                lat, lon = _nc_coord(src, ['latitude', 'lat']), _nc_coord(src, ['longitude', 'lon'])
+                if len(dst.dimensions) == 0:
+                    dst.createDimension('time', len(times))
+                    dst.createDimension('latitude', len(lat))
+                    dst.createDimension('longitude', len(lon))
+                    t = dst.createVariable('time', 'i4', ('time',))
+                    t.units, t.calendar = 'hours since 1900-01-01 00:00:00', 'gregorian'
+                    t[:] = (times - pd.Timestamp('1900-01-01'))//pd.Timedelta(hours=1)
+                    for out, coord in [('latitude', lat), ('longitude', lon)]:
+                        dst.createVariable(out, 'f4', (out,))
+                        dst[out][:], dst[out].units = coord[:], coord.units
+                itime = times.get_indexer(index[f])
+                for name, var in src.variables.items():
+                    if var.ndim < 3: continue
+                    if name not in dst.variables:
+                        shape = (len(times), len(lat), len(lon))
+                        out = dst.createVariable(name, 'f4', ('time', 'latitude', 'longitude'), zlib=True,
+                                                 chunksizes=tuple(min(c, n) for c, n in zip(chunks, shape)),
+                                                 fill_value=np.float32(-32767))
+                        out.setncatts({k: var.getncattr(k) for k in ['units', 'long_name'] if k in var.ncattrs()})
+                    for i in range(0, len(itime), block):
+                        dst[name][itime[i:i+block]] = _read_field(var, slice(i, i+block), slice(None), slice(None))
+    os.replace(f'{file}.part', file)
+
+def _index(indices):
+    "Slice for evenly spaced `indices` so netcdf reads them with strides, otherwise the indices."
+    if len(indices) == 1: return slice(indices[0], indices[0]+1)
+    step = np.diff(indices)
+    if (step == step[0]).all() and step[0] > 0: return slice(indices[0], indices[-1]+1, step[0])
+    return indices
+
+def era5_read(file, region:RegionST, variables:list=None):
+    """Reads the times and area of `region` from the merged netcdf `file` reading only the chunks they need.
+    Returns a dict with `time`, `latitude`, `longitude` and the arrays of each variable (all by default)."""
+    with Dataset(file) as nc:
+        times = _nc_times(nc)
+        itime = np.where(times.isin(region.times))[0]
+        lat, lon = _nc_coord(nc, ['latitude', 'lat'])[:], _nc_coord(nc, ['longitude', 'lon'])[:]
+        ilat = np.where((lat >= region.bbox.bottom-1e-4) & (lat <= region.bbox.top+1e-4))[0]
+        ilon = np.where((lon >= region.bbox.left-1e-4) & (lon <= region.bbox.right+1e-4))[0]
+        out = {'time': times[itime], 'latitude': lat[ilat], 'longitude': lon[ilon]}
+        if len(itime) == 0 or len(ilat) == 0 or len(ilon) == 0: return out
+        sl = (_index(itime), slice(ilat[0], ilat[-1]+1), slice(ilon[0], ilon[-1]+1))
+        if variables is None: variables = [k for k, v in nc.variables.items() if v.ndim == 3]
+        for v in variables: out[v] = nc[_nc_name(nc, v)][sl]
+    return out
\ No newline at end of file
@@ -1,15 +1,14 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_external.ipynb (unless otherwise specified).
 
-__all__ = ['geturl', 'sync', 'USERAGENT', 'DESC']
+__all__ = ['Cksum', 'cksum', 'configure_session', 'get_session', 'geturl', 'download_url', 'sync', 'USERAGENT',
+           'CHUNK_SIZE', 'DESC']
 
 # Cell
 # Source: https://ladsweb.modaps.eosdis.nasa.gov/tools-and-services/data-download-scripts/#samples
 #!/usr/bin/env python
 
-# script supports either python2 or python3
-#
-# Attempts to do HTTP Gets with urllib2(py2) urllib.requets(py3) or subprocess
-# if tlsv1.1+ isn't supported by the python ssl module
+# Modified to do HTTP Gets through a shared requests session that keeps a pool of
+# keep-alive connections, so repeated requests to the same host reuse TLS connections
 #
 # Will download csv or json depending on which python module is available
 #
@@ -21,6 +20,11 @@ import os
 import os.path
 import shutil
 import sys
+import threading
+import zlib
+from time import sleep
+import requests
+from requests.adapters import HTTPAdapter
 
 try:
     from StringIO import StringIO   # python2
@@ -32,6 +36,77 @@ except ImportError:
 
 
 USERAGENT = 'tis/download.py_1.0--' + sys.version.replace('\n','').replace('\n','')
+CHUNK_SIZE = 1024*1024
+
+_session, _session_lock = None, threading.Lock()
+
+
+# Maps each byte to its bit-reversed value, so zlib's reflected CRC-32 can compute the
+# non-reflected CRC used by POSIX cksum (same polynomial, 0x04C11DB7)
+_REVERSE_BITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def _reverse32(x):
+    return int('{:032b}'.format(x)[::-1], 2)
+
+
+class Cksum():
+    "POSIX `cksum` CRC computed incrementally from the bytes passed to `update`."
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.length, self._crc = 0, 0xffffffff
+
+    def update(self, data:bytes):
+        self._crc = zlib.crc32(data.translate(_REVERSE_BITS), self._crc)
+        self.length += len(data)
+
+    @property
+    def value(self):
+        "The CRC as printed by `cksum`, after appending the length as cksum does."
+        n, tail = self.length, bytearray()
+        while n > 0:
+            tail.append(n & 0xff)
+            n >>= 8
+        crc = zlib.crc32(bytes(tail).translate(_REVERSE_BITS), self._crc)
+        return _reverse32(crc ^ 0xffffffff) ^ 0xffffffff
+
+
+def cksum(file, hasher=None):
+    "Computes the POSIX `cksum` CRC of `file` without spawning a process."
+    if hasher is None: hasher = Cksum()
+    with open(file, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''): hasher.update(chunk)
+    return hasher.value
+
+
+def _new_session(pool_connections=10, pool_maxsize=32, max_retries=0):
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                          max_retries=max_retries)
+    session = requests.Session()
+    session.headers.update({'user-agent': USERAGENT})
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure_session(pool_connections:int=10, pool_maxsize:int=32, max_retries:int=0):
+    "Replace the shared session with one keeping `pool_connections` host pools of `pool_maxsize` connections."
+    global _session
+    session = _new_session(pool_connections, pool_maxsize, max_retries)
+    with _session_lock:
+        old, _session = _session, session
+    if old is not None: old.close()
+    return session
+
+
+def get_session():
+    "Shared `requests.Session` with keep-alive connection pools, used for all HTTP requests."
+    global _session
+    with _session_lock:
+        if _session is None: _session = _new_session()
+        return _session
 
 
 def geturl(url, token=None, out=None):
@@ -39,56 +114,95 @@ def geturl(url, token=None, out=None):
     if not token is None:
         headers['Authorization'] = 'Bearer ' + token
     try:
-        import ssl
-        CTX = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        if sys.version_info.major == 2:
-            import urllib2
-            try:
-                fh = urllib2.urlopen(urllib2.Request(url, headers=headers), context=CTX, timeout=120)
-                if out is None:
-                    return fh.read()
-                else:
-                    shutil.copyfileobj(fh, out)
-            except urllib2.HTTPError as e:
-                print('HTTP GET error code: %d' % e.code(), file=sys.stderr)
-                print('HTTP GET error message: %s' % e.message, file=sys.stderr)
-            except urllib2.URLError as e:
-                print('Failed to make request: %s' % e.reason, file=sys.stderr)
-            return None
-
-        else:
-            from urllib.request import urlopen, Request, URLError, HTTPError
-            try:
-                fh = urlopen(Request(url, headers=headers), context=CTX, timeout=120)
-                if out is None:
-                    return fh.read().decode('utf-8')
-                else:
-                    shutil.copyfileobj(fh, out)
-            except HTTPError as e:
-                print('HTTP GET error code: %d' % e.code(), file=sys.stderr)
-                print('HTTP GET error message: %s' % e.message, file=sys.stderr)
-            except URLError as e:
-                print('Failed to make request: %s' % e.reason, file=sys.stderr)
-            return None
-
-    except AttributeError:
-        # OS X Python 2 and 3 don't support tlsv1.1+ therefore... curl
-        import subprocess
-        try:
-            args = ['curl', '--fail', '-sS', '-L', '--get', url]
-            for (k,v) in headers.items():
-                args.extend(['-H', ': '.join([k, v])])
+        with get_session().get(url, headers=headers, timeout=120, stream=out is not None) as r:
+            r.raise_for_status()
             if out is None:
-                # python3's subprocess.check_output returns stdout as a byte string
-                result = subprocess.check_output(args)
-                return result.decode('utf-8') if isinstance(result, bytes) else result
+                return r.content.decode('utf-8')
             else:
-                subprocess.call(args, stdout=out)
-        except subprocess.CalledProcessError as e:
-            print('curl GET error message: %' + (e.message if hasattr(e, 'message') else e.output), file=sys.stderr)
-        return None
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE): out.write(chunk)
+    except requests.HTTPError as e:
+        print('HTTP GET error code: %d' % e.response.status_code, file=sys.stderr)
+        print('HTTP GET error message: %s' % e.response.reason, file=sys.stderr)
+    except requests.RequestException as e:
+        print('Failed to make request: %s' % e, file=sys.stderr)
+    return None
+
 
 
+def _rehash(hasher, file, size):
+    "Reset `hasher` and update it with the first `size` bytes of `file`."
+    hasher.reset()
+    with open(file, 'rb') as fh:
+        while size > 0:
+            chunk = fh.read(min(CHUNK_SIZE, size))
+            if not chunk: break
+            hasher.update(chunk)
+            size -= len(chunk)
+
+
+def _remove(*files):
+    for f in files:
+        if os.path.exists(f): os.remove(f)
+
+def download_url(url, file, token=None, n_tries:int=5, wait:float=1, hasher=None):
+    """Download `url` to `file` through a `.part` file, resuming with HTTP Range requests after a failure.
+    Resumes send `If-Range` with the ETag or Last-Modified of the first response, kept in a `.part.validator`
+    file, so the download restarts if the remote file changed.
+    If a `hasher` (e.g. `Cksum`) is given it is updated with the bytes as they are written."""
+    file = str(file)
+    part, validator_file = file + '.part', file + '.part.validator'
+    headers = {}
+    if not token is None:
+        headers['Authorization'] = 'Bearer ' + token
+    for i in range(n_tries):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        validator = None
+        if offset > 0 and os.path.exists(validator_file):
+            with open(validator_file, 'r') as f: validator = f.read().strip()
+        if offset > 0 and not validator:
+            # Without a validator the .part can't be matched with the remote file
+            _remove(part, validator_file)
+            offset = 0
+        headers.pop('Range', None), headers.pop('If-Range', None)
+        if offset > 0: headers['Range'], headers['If-Range'] = 'bytes=%d-' % offset, validator
+        try:
+            with get_session().get(url, headers=headers, timeout=120, stream=True) as r:
+                if offset > 0 and r.status_code == 416:
+                    # The .part is complete only if it has the size of the remote file (Content-Range: bytes */N)
+                    size = r.headers.get('Content-Range', '').rpartition('/')[2]
+                    if not size.isdigit() or int(size) != offset:
+                        _remove(part, validator_file)
+                        raise IOError('Partial download of %s does not match the remote file, restarting' % url)
+                    if hasher is not None and hasher.length != offset: _rehash(hasher, part, offset)
+                else:
+                    r.raise_for_status()
+                    # Servers ignoring the Range header, or whose file changed, send the whole file again
+                    mode, expected = ('ab', offset) if r.status_code == 206 else ('wb', 0)
+                    if mode == 'wb':
+                        etag = r.headers.get('ETag', '')
+                        validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified', '')
+                        with open(validator_file, 'w') as f: f.write(validator)
+                    if hasher is not None and hasher.length != expected: _rehash(hasher, part, expected)
+                    if 'Content-Length' in r.headers: expected += int(r.headers['Content-Length'])
+                    else: expected = None
+                    with open(part, mode) as fh:
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            fh.write(chunk)
+                            if hasher is not None: hasher.update(chunk)
+                    if expected is not None and os.path.getsize(part) != expected:
+                        raise IOError('Incomplete download of %s' % url)
+            os.replace(part, file)
+            _remove(validator_file)
+            return True
+        except requests.HTTPError as e:
+            print('HTTP GET error code: %d' % e.response.status_code, file=sys.stderr)
+            print('HTTP GET error message: %s' % e.response.reason, file=sys.stderr)
+            if e.response.status_code == 404: break
+        except (requests.RequestException, IOError) as e:
+            print('Failed to download %s: %s' % (url, e), file=sys.stderr)
+        if i < n_tries-1: sleep(min(wait*2**i, 60))
+    return False
+
 
 ################################################################################
 
@@ -123,8 +237,7 @@ def sync(src, dest, tok):
             try:
                 if not os.path.exists(path):
                     print('downloading: ' , path)
-                    with open(path, 'w+b') as fh:
-                        geturl(url, tok, fh)
+                    download_url(url, path, tok)
                 else:
                     print('skipping: ', path)
             except IOError as e:
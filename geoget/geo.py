@@ -1,12 +1,13 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/04_geo.ipynb (unless otherwise specified).
 
-__all__ = ['country_bounding_boxes', 'dict2json', 'Region', 'RegionST']
+__all__ = ['country_bounding_boxes', 'dict2json', 'Region', 'run_tiles', 'RegionST', 'CountryIndex']
 
 # Cell
 import rasterio
 import numpy as np
 import pandas as pd
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 # Cell
 # extracted from http//www.naturalearthdata.com/download/110m/cultural/ne_110m_admin_0_countries.zip
@@ -200,20 +201,35 @@ class Region():
         self.bbox = rasterio.coords.BoundingBox(*bbox) # left, bottom, right, top
         self.pixel_size = pixel_size
 
+    # Pixel offsets of the `offset` names used by rasterio.transform.xy as (column, row)
+    _offsets = {'center': (0.5, 0.5), 'ul': (0, 0), 'ur': (1, 0), 'll': (0, 1), 'lr': (1, 1)}
+
+    def _grid(self):
+        "Dict with the grid geometry, computed again only when `bbox` or `pixel_size` change."
+        key = (tuple(self.bbox), self.pixel_size)
+        grid = self.__dict__.get('_grid_cache')
+        if grid is None or grid['key'] != key:
+            width = int(np.round(np.abs(self.bbox.left-self.bbox.right)/self.pixel_size))
+            height = int(np.round(np.abs(self.bbox.top-self.bbox.bottom)/self.pixel_size))
+            grid = {'key': key, 'width': width, 'height': height,
+                    'transform': rasterio.transform.from_bounds(*self.bbox, width, height)}
+            self._grid_cache = grid
+        return grid
+
     @property
     def width(self):
         "Width of the region"
-        return int(np.round(np.abs(self.bbox.left-self.bbox.right)/self.pixel_size))
+        return self._grid()['width']
 
     @property
     def height(self):
         "Height of the region"
-        return int(np.round(np.abs(self.bbox.top-self.bbox.bottom)/self.pixel_size))
+        return self._grid()['height']
 
     @property
     def transform(self):
         "Rasterio Affine transform of the region"
-        return rasterio.transform.from_bounds(*self.bbox, self.width, self.height)
+        return self._grid()['transform']
 
     @property
     def shape(self):
@@ -222,10 +238,71 @@ class Region():
 
     def coords(self, offset='ul'):
         "Computes longitude and latitude arrays given a shape and a rasterio Affine transform"
-        rxy = rasterio.transform.xy
-        ys, xs = map(range, self.shape)
-        return (np.array(rxy(self.transform, [0]*len(xs), xs, offset=offset)[0]),
-                np.array(rxy(self.transform, ys, [0]*len(ys), offset=offset)[1]))
+        grid = self._grid()
+        if offset not in grid:
+            lon, lat = self.xy(np.zeros(grid['width']), np.arange(grid['width']), offset)[0], \
+                       self.xy(np.arange(grid['height']), np.zeros(grid['height']), offset)[1]
+            lon.flags.writeable, lat.flags.writeable = False, False
+            grid[offset] = (lon, lat)
+        return grid[offset]
+
+    def xy(self, rows, cols, offset='center'):
+        "Longitudes and latitudes of the pixels at arrays of `rows` and `cols`, as `rasterio.transform.xy`."
+        coff, roff = self._offsets[offset]
+        t = self.transform
+        cols, rows = np.asarray(cols) + coff, np.asarray(rows) + roff
+        return t.a*cols + t.b*rows + t.c, t.d*cols + t.e*rows + t.f
+
+    def rowcol(self, lons, lats, op=np.floor):
+        "Rows and columns of the pixels containing arrays of `lons` and `lats`, as `rasterio.transform.rowcol`."
+        inv = ~self.transform
+        lons, lats = np.asarray(lons), np.asarray(lats)
+        cols, rows = inv.a*lons + inv.b*lats + inv.c, inv.d*lons + inv.e*lats + inv.f
+        return op(rows).astype(int), op(cols).astype(int)
+
+    def subregion(self, name:str, rows:slice, cols:slice):
+        "Copy of the region (including times for `RegionST`) cropped to the pixels `rows` and `cols`."
+        t = self.transform
+        left, top = t.c + cols.start*t.a, t.f + rows.start*t.e
+        right, bottom = t.c + cols.stop*t.a, t.f + rows.stop*t.e
+        region = type(self).__new__(type(self))
+        region.__dict__.update({k: v for k, v in self.__dict__.items() if not k.startswith('_')})
+        region.name = name
+        region.bbox = rasterio.coords.BoundingBox(*np.round([left, bottom, right, top], 10))
+        return region
+
+    def window(self, region):
+        "Rows and columns slices of the pixels of `region`, aligned to this region's grid, in this region."
+        row, col = [int(o) for o in self.rowcol(region.bbox.left, region.bbox.top, op=np.round)]
+        return slice(row, row+region.height), slice(col, col+region.width)
+
+    def tiles(self, size=None, n=None):
+        """Splits the region into pixel aligned tiles of `size` pixels (int or (height, width)) or into
+        about `n` tiles (int or (rows, columns)). Tiles cover the region without gaps or overlaps."""
+        height, width = self.shape
+        if size is not None:
+            size = (size, size) if isinstance(size, int) else size
+            rows, cols = np.arange(0, height, size[0]).tolist() + [height], np.arange(0, width, size[1]).tolist() + [width]
+        elif n is not None:
+            if isinstance(n, int):
+                nrows = min(height, max(1, int(np.round(np.sqrt(n*height/width)))))
+                n = (nrows, min(width, int(np.ceil(n/nrows))))
+            rows = np.linspace(0, height, n[0]+1).round().astype(int).tolist()
+            cols = np.linspace(0, width, n[1]+1).round().astype(int).tolist()
+        else: raise ValueError('Either size or n is required')
+        return [self.subregion(f'{self.name}_{i}_{j}', slice(r0, r1), slice(c0, c1))
+                for i, (r0, r1) in enumerate(zip(rows[:-1], rows[1:]))
+                for j, (c0, c1) in enumerate(zip(cols[:-1], cols[1:]))]
+
+    def mosaic(self, tiles:list, arrays:list, fill=np.nan):
+        "Places the `arrays` (..., height, width) computed for each of the `tiles` on the grid of the region."
+        out = None
+        for tile, array in zip(tiles, arrays):
+            array = np.asarray(array)
+            if out is None: out = np.full(array.shape[:-2] + self.shape, fill, dtype=np.result_type(array, type(fill)))
+            rows, cols = self.window(tile)
+            out[..., rows, cols] = array
+        return out
 
     @classmethod
     def load(cls, file):
@@ -234,14 +311,29 @@ class Region():
             args = json.load(f)
         return cls(args['name'], args['bbox'], args['pixel_size'])
 
+    @classmethod
+    def from_countries(cls, codes, pixel_size:float, name:str=None, **kwargs):
+        """Region covering the bounding boxes of the countries with ISO `codes`, snapped outwards to `pixel_size`.
+        Other arguments (e.g. times of `RegionST`) are passed to the constructor."""
+        codes = [codes] if isinstance(codes, str) else list(codes)
+        left, bottom, right, top = CountryIndex().bbox(codes)
+        bbox = [np.floor(left/pixel_size)*pixel_size, np.floor(bottom/pixel_size)*pixel_size,
+                np.ceil(right/pixel_size)*pixel_size, np.ceil(top/pixel_size)*pixel_size]
+        return cls('_'.join(codes) if name is None else name, np.round(bbox, 10).tolist(), pixel_size, **kwargs)
+
     def export(self, file):
         """Exports region information to json file"""
-        dict2json(self.__dict__, file)
+        dict2json({k: v for k, v in self.__dict__.items() if not k.startswith('_')}, file)
 
     def __repr__(self):
-        return '\n'.join([f'{i}: {o}' for i, o in self.__dict__.items()]) + '\n'
+        return '\n'.join([f'{i}: {o}' for i, o in self.__dict__.items() if not i.startswith('_')]) + '\n'
 
 
+def run_tiles(func, tiles:list, max_workers:int=8):
+    "Runs `func(tile)` for each of the `tiles` with `max_workers` threads and returns the results in order."
+    with ThreadPoolExecutor(max_workers) as e:
+        return list(e.map(func, tiles))
+
 class RegionST(Region):
     "Defines a region in space and time with a name, a bounding box and the pixel size."
     def __init__(self, name:str, bbox:list, pixel_size:float, time_start:str=None,
@@ -271,4 +363,59 @@ class RegionST(Region):
         if time_end is None:
             time_end = args['time_end']
         return cls(args['name'], args['bbox'], args['pixel_size'],
-                   time_start, time_end)
\ No newline at end of file
+                   time_start, time_end)
+
+# Cell
+class CountryIndex():
+    """Array index of `boxes` (a dict like `country_bounding_boxes`) for vectorized spatial queries.
+    Boxes are bucketed in a grid of `cell` degrees so point queries only test the boxes of their cell."""
+    def __init__(self, boxes:dict=country_bounding_boxes, cell:float=10):
+        self.codes = np.array(list(boxes.keys()))
+        self.names = np.array([o[0] for o in boxes.values()])
+        self.left, self.bottom, self.right, self.top = np.array([o[1] for o in boxes.values()], dtype=float).T
+        self.cell = cell
+        # Smaller boxes first so points get the most specific country
+        self._order = np.argsort((self.right-self.left)*(self.top-self.bottom), kind='stable')
+        self._ncols, nrows = int(np.ceil(360/cell)), int(np.ceil(180/cell))
+        self._buckets = {}
+        for i in self._order:
+            c0, c1 = self._cell_col(self.left[i]), self._cell_col(self.right[i])
+            r0, r1 = self._cell_row(self.bottom[i]), self._cell_row(self.top[i])
+            for r in range(r0, r1+1):
+                for c in range(c0, c1+1): self._buckets.setdefault(r*self._ncols+c, []).append(i)
+        self._buckets = {k: np.array(v) for k, v in self._buckets.items()}
+
+    def _cell_col(self, lon): return np.clip(np.floor((np.asarray(lon)+180)/self.cell), 0, self._ncols-1).astype(int)
+    def _cell_row(self, lat): return np.clip(np.floor((np.asarray(lat)+90)/self.cell), 0, int(np.ceil(180/self.cell))-1).astype(int)
+
+    def contains(self, lons, lats):
+        "Codes of the smallest country box containing each point of `lons` and `lats` ('' if none)."
+        lons, lats = np.atleast_1d(lons).astype(float), np.atleast_1d(lats).astype(float)
+        out = np.full(lons.shape, '', dtype=self.codes.dtype)
+        cells = self._cell_row(lats)*self._ncols + self._cell_col(lons)
+        for cell in np.unique(cells):
+            candidates = self._buckets.get(cell)
+            if candidates is None: continue
+            idx = np.where(cells == cell)[0]
+            x, y = lons[idx, None], lats[idx, None]
+            inside = ((x >= self.left[candidates]) & (x <= self.right[candidates]) &
+                      (y >= self.bottom[candidates]) & (y <= self.top[candidates]))
+            found = inside.any(1)
+            out[idx[found]] = self.codes[candidates[inside[found].argmax(1)]]
+        return out
+
+    def intersects(self, bbox:list):
+        "Codes of the countries whose box intersects `bbox` (left, bottom, right, top)."
+        left, bottom, right, top = bbox
+        mask = (self.left <= right) & (self.right >= left) & (self.bottom <= top) & (self.top >= bottom)
+        return self.codes[mask].tolist()
+
+    def bbox(self, codes:list):
+        "Bounding box (left, bottom, right, top) of the union of the boxes of `codes`."
+        mask = np.isin(self.codes, codes)
+        missing = set(codes) - set(self.codes[mask])
+        if len(missing) > 0: raise KeyError(f'Unknown country codes: {", ".join(sorted(missing))}')
+        return (self.left[mask].min(), self.bottom[mask].min(), self.right[mask].max(), self.top[mask].max())
+
+    def __repr__(self):
+        return f'CountryIndex({len(self.codes)} boxes, cell={self.cell})'
\ No newline at end of file
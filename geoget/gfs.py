@@ -1,10 +1,16 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05_gfs.ipynb (unless otherwise specified).
 
-__all__ = ['GFS']
+__all__ = ['parse_idx', 'select_messages', 'byte_ranges', 'download_messages', 'grib_to_netcdf', 'cube_chunks',
+           'GFS_PROD_URL', 'SURFACE_LEVELS', 'PRESSURE_LEVELS', 'GFS']
 
 # Cell
 import os
 import re
+import subprocess
+import threading
+import warnings
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from pathlib import Path
 import pandas as pd
@@ -12,16 +18,139 @@ from netCDF4 import Dataset
 import numpy as np
 import matplotlib.pyplot as plt
 
+from .external import get_session, cksum, CHUNK_SIZE
+from .cache import DiskCache, cache_path
+
+# Cell
+GFS_PROD_URL = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod'
+SURFACE_LEVELS = ['surface', 'mean sea level', '2 m above ground', '10 m above ground']
+PRESSURE_LEVELS = [1000, 975, 950, 925, 900, 850, 800, 750, 700, 650, 600, 550, 500, 450, 400,
+                   350, 300, 250, 200, 150, 100, 70, 50, 40, 30, 20, 15, 10, 7, 5, 3, 2, 1]
+
+def parse_idx(text):
+    """Parse a GRIB `.idx` inventory (lines `n:offset:d=date:VAR:level:forecast:`) into a list of
+    dicts with the byte range `start`-`end` of each message; `end` is None for the last message."""
+    entries = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 6: continue
+        entries.append({'n': int(fields[0]), 'start': int(fields[1]), 'date': fields[2][2:],
+                        'var': fields[3], 'level': fields[4], 'forecast': fields[5]})
+    for entry, following in zip(entries, entries[1:]):
+        entry['end'] = following['start']-1
+    if len(entries) > 0: entries[-1]['end'] = None
+    return entries
+
+def select_messages(entries, bands_sf=None, bands_pl=None, levels_pl=PRESSURE_LEVELS):
+    "Select the `entries` of `bands_sf` at the surface levels and of `bands_pl` at `levels_pl` (mb)."
+    bands_sf, bands_pl = bands_sf or [], bands_pl or []
+    levels_pl = [f'{level} mb' for level in levels_pl]
+    return [e for e in entries if (e['var'] in bands_sf and e['level'] in SURFACE_LEVELS) or
+                                  (e['var'] in bands_pl and e['level'] in levels_pl)]
+
+def byte_ranges(entries):
+    "Coalesce the byte ranges of consecutive `entries` into a list of `(start, end)` tuples."
+    ranges = []
+    for e in sorted(entries, key=lambda e: e['start']):
+        if len(ranges) > 0 and ranges[-1][1] is not None and ranges[-1][1]+1 == e['start']:
+            ranges[-1] = (ranges[-1][0], e['end'])
+        else: ranges.append((e['start'], e['end']))
+    return ranges
+
+def download_messages(urls, file, n_tries:int=5, wait:float=1):
+    """Download the GRIB messages served by each url in `urls` and concatenate them into `file`.
+    Items of `urls` can also be `(url, start, end)` tuples to fetch only those bytes with a Range request.
+    Each message is self-contained so the result is a valid GRIB file holding all of them."""
+    file = str(file)
+    part = file + '.part'
+    for i in range(n_tries):
+        try:
+            with open(part, 'wb') as fh:
+                for url in urls:
+                    headers = {}
+                    if isinstance(url, tuple):
+                        url, start, end = url
+                        headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+                    with get_session().get(url, headers=headers, timeout=120, stream=True) as r:
+                        r.raise_for_status()
+                        if 'Range' in headers and r.status_code != 206:
+                            raise IOError(f'Range requests are not supported by {url}')
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE): fh.write(chunk)
+            os.replace(part, file)
+            return True
+        except (requests.RequestException, IOError) as e:
+            warnings.warn(f'Failed to download {file}: {e}', UserWarning)
+            if isinstance(e, requests.HTTPError) and e.response.status_code == 404: break
+        if i < n_tries-1: sleep(min(wait*2**i, 60))
+    if os.path.exists(part): os.remove(part)
+    return False
+
+def grib_to_netcdf(grib_file, nc_file, bbox:list=None):
+    """Decode all messages of `grib_file` in-process with cfgrib and write them to a single netcdf file.
+    Variables follow the cfgrib/ecCodes short names (e.g. `t2m`, `u10`, `t`) and pressure levels
+    are stored along the `isobaricInhPa` dimension, even for a single level. Other levels (e.g. `heightAboveGround`)
+    are kept as attributes of their variables. If `bbox` is given the fields are cropped to it."""
+    try:
+        import cfgrib
+        import xarray as xr
+    except ImportError:
+        raise ImportError('In-process conversion requires cfgrib and xarray: `pip install cfgrib xarray`')
+    datasets = cfgrib.open_datasets(str(grib_file), backend_kwargs={'indexpath': ''})
+    try:
+        names, fields = set(), []
+        for ds in datasets:
+            # A single pressure level is read as a scalar coordinate, kept as a length 1 level dimension
+            if 'isobaricInhPa' in ds.coords and 'isobaricInhPa' not in ds.dims: ds = ds.expand_dims('isobaricInhPa')
+            # Other scalar level coordinates (e.g. heightAboveGround=2 and 10) clash on merge, so they are
+            # kept as attributes of the variables
+            scalars = [c for c in ds.coords if c not in ds.dims and c not in ['time', 'step', 'valid_time']]
+            for v in ds.data_vars: ds[v].attrs.update({c: ds[c].item() for c in scalars if ds[c].ndim == 0})
+            ds = ds.drop_vars(scalars)
+            # Same short name on different level types (e.g. t on surface and on pressure levels)
+            rename = {v: f'{v}_{ds[v].attrs.get("GRIB_typeOfLevel", "level")}' for v in ds.data_vars if v in names}
+            ds = ds.rename(rename)
+            names.update(ds.data_vars)
+            fields.append(ds)
+        ds = xr.merge(fields, compat='override', combine_attrs='drop_conflicts')
+        if bbox is not None:
+            left, bottom, right, top = bbox
+            if left < 0: ds = ds.assign_coords(longitude=(ds.longitude+180)%360-180).sortby('longitude')
+            lat = slice(top, bottom) if ds.latitude[0] > ds.latitude[-1] else slice(bottom, top)
+            ds = ds.sel(latitude=lat, longitude=slice(left, right))
+        ds.load().to_netcdf(nc_file)
+    finally:
+        for ds in datasets: ds.close()
+
+def cube_chunks(shape, chunks='field'):
+    """Chunk sizes of a `(time, [level,] lat, lon)` cube variable with `shape`.
+    'field' stores one horizontal field per chunk, which is cheap to write hour by hour and fast for map reads.
+    'timeseries' keeps blocks of 24 hours of 32x32 tiles for fast point time series reads; since the cube is
+    written one hour at a time each hour recompresses the chunks of its 24 hour block, so writing is several
+    times slower than with 'field'. A `(time, level, lat, lon)` tuple sets the sizes explicitly
+    (the level entry is ignored for variables without levels)."""
+    if chunks == 'timeseries': chunks = (24, 1, 32, 32)
+    elif chunks == 'field': chunks = (1, 1) + tuple(shape[-2:])
+    elif not isinstance(chunks, tuple) or len(chunks) != 4:
+        raise ValueError(f'Unknown chunks {chunks}, use "timeseries", "field" or a (time, level, lat, lon) tuple')
+    if len(shape) == 3: chunks = chunks[:1] + chunks[2:]
+    return tuple(min(c, n) for c, n in zip(chunks, shape))
+
 # Cell
 class GFS():
     def __init__(self, path:Path, bbox:list=None, bands_sf:list=None, bands_pl:list=None,
-                 last_forecast='f120', **kwargs):
+                 last_forecast='f120', source:str='filter', base_url:str=GFS_PROD_URL, cache:DiskCache=None,
+                 listing_ttl:float=60, **kwargs):
         """
         path - path to save the data;
         bbox - region bounds in format [left, bottom, right top];
         bands_sf - variables for surface/mean sea level/2m/10m
         bands_pl - variables for pressure levels 1000mb up to 1mb
         last_forecast - download hourly data up to last_forecast step defined
+        source - 'filter' to subset on the NOMADS grib filter or 'idx' to fetch only the requested
+                 messages from the `.idx` inventory of each file with Range requests and crop locally
+        base_url - directory with the gfs.{date}/{run}/atmos files for the 'idx' source
+        cache - cache of the server listings, set `cache=False` to always request them
+        listing_ttl - seconds during which a cached listing is used without asking the server
         find_last
         """
         self.path = path
@@ -32,21 +161,60 @@ class GFS():
         self.bands_sf = bands_sf
         self.bands_pl = bands_pl
         self.last_forecast = last_forecast
+        self.source = source
+        self.base_url = base_url.rstrip('/')
         self.find_last = True
+        # Listings are kept for a day to revalidate them with conditional requests after `listing_ttl`
+        self.cache = DiskCache(cache_path('gfs_listings')) if cache is None else cache
+        self.listing_ttl = listing_ttl
+        self._manifest_lock = threading.Lock()
+        self._cube_lock = threading.Lock()
 
         if not (self.path/'log.csv').is_file():
             with open(self.path/'log.csv','a') as fd:
                 fd.write('date,run\n')
+        if not (self.path/'manifest.csv').is_file():
+            with open(self.path/'manifest.csv','a') as fd:
+                fd.write('date,run,forecast,file,size,cksum\n')
+
 
+    def _get_listing(self, url):
+        """Get the listing page `url`. A cached copy is used while younger than `listing_ttl` and is
+        then revalidated with its ETag/Last-Modified so an unchanged listing is not downloaded again."""
+        entry = self.cache.get(url) if self.cache else None
+        if entry is not None and time() - entry['time'] < self.listing_ttl: return entry['text']
+        headers = {}
+        if entry is not None and entry['etag'] is not None: headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None: headers['If-Modified-Since'] = entry['last_modified']
+        r = get_session().get(url, headers=headers, timeout=60)
+        if r.status_code == 304 and entry is not None: text = entry['text']
+        else:
+            r.raise_for_status()
+            text, entry = r.text, {'etag': None, 'last_modified': None}
+        if self.cache:
+            self.cache.set(url, {'text': text, 'time': time(), 'etag': r.headers.get('ETag', entry['etag']),
+                                 'last_modified': r.headers.get('Last-Modified', entry['last_modified'])})
+        return text
+
+    def dates_available(self):
+        "List the dates with GFS runs on the server."
+        if self.source == 'idx':
+            return sorted(set(re.findall(r'gfs\.([0-9]{8})/', self._get_listing(f'{self.base_url}/'))))
+        url = f"https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl"
+        return sorted(re.findall('dir=%2Fgfs.(.*?)">', self._get_listing(url)))
+
+    def runs_available(self, tstr):
+        "List the runs of day `tstr` on the server."
+        if self.source == 'idx':
+            return sorted(set(re.findall(r'"([0-9]{2})/"', self._get_listing(f'{self.base_url}/gfs.{tstr}/'))))
+        url = f"https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl?dir=%2Fgfs.{tstr}"
+        return sorted(re.findall('">(.*?)</a>', self._get_listing(url)))
 
     def search_times(self):
+        dates_available = self.dates_available()
+        runs_available = self.runs_available(dates_available[-1])
+        forecast_times = self.run_hours(dates_available[-1], runs_available[-1])
         if self.find_last:
-            url = f"https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl"
-            dates_available = sorted(re.findall('dir=%2Fgfs.(.*?)">', requests.get(url).text))
-            url += '?dir=%2Fgfs.' + dates_available[-1]
-            runs_available = sorted(re.findall('">(.*?)</a>', requests.get(url).text))
-            url += f'%2F{runs_available[-1]}'
-            forecast_times = re.findall('pgrb2.0p25.(.*?)">', requests.get(url).text)
             if self.last_forecast in forecast_times:
                 return dates_available[-1], runs_available[-1]
             elif len(runs_available)>1:
@@ -56,6 +224,7 @@ class GFS():
         else: return dates_available, runs_available, forecast_times
 
     def search_files(self, tstr, run_time, forecast_hour):
+        if self.source == 'idx': return self.search_messages(tstr, run_time, forecast_hour)
         path = self.path
         left, bottom, right, top = self.bbox
         file_sf, file_pl = None, None
@@ -89,9 +258,158 @@ class GFS():
         else: return None, None
 
 
-    def run(self, to_netcdf=True, delete_old=False, replace=False):
-        path = str(self.path)
-        tstr, run_time = self.search_times()
+    def search_messages(self, tstr, run_time, forecast_hour):
+        "Return `(url, start, end)` byte ranges of the requested messages of a forecast hour from its `.idx` file."
+        url = f'{self.base_url}/gfs.{tstr}/{run_time}/atmos/gfs.t{run_time}z.pgrb2.0p25.{forecast_hour}'
+        r = get_session().get(f'{url}.idx', timeout=60)
+        r.raise_for_status()
+        entries = select_messages(parse_idx(r.text), self.bands_sf, self.bands_pl)
+        return [(url, start, end) for start, end in byte_ranges(entries)]
+
+    def latest_run(self):
+        "Return the date, run and forecast hours already published for the latest GFS run."
+        dates_available = self.dates_available()
+        runs_available = self.runs_available(dates_available[-1])
+        return dates_available[-1], runs_available[-1], self.run_hours(dates_available[-1], runs_available[-1])
+
+    def poll(self):
+        """Return the date and run of the latest run if it is not yet complete in `log.csv`, else None.
+        The listings are cached and revalidated, so polling when nothing changed costs no downloads."""
+        dates_available = self.dates_available()
+        tstr, run_time = dates_available[-1], self.runs_available(dates_available[-1])[-1]
+        log_tstr, log_run_time = self.last_log
+        if log_tstr is not None and str(log_tstr) == tstr and run_time == f'{log_run_time:02d}': return None
+        return tstr, run_time
+
+    def run_hours(self, tstr, run_time):
+        "List the forecast hours published for run `run_time` of day `tstr`."
+        if self.source == 'idx':
+            # The inventory is written after the grib file so it marks complete files
+            text = self._get_listing(f'{self.base_url}/gfs.{tstr}/{run_time}/atmos/')
+            return sorted(set(re.findall(f'gfs.t{run_time}z.pgrb2.0p25.(f[0-9]+).idx', text)))
+        url = f"https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl?dir=%2Fgfs.{tstr}%2F{run_time}"
+        return sorted(set(re.findall('pgrb2.0p25.(f[0-9]+)">', self._get_listing(url))))
+
+    def update_manifest(self, tstr, run_time, f, file, name=None):
+        """Record forecast hour `f` of a run as complete with the size and checksum of `file`.
+        `name` is the file recorded for the hour if it differs, i.e. the cube it was written to."""
+        file = Path(file)
+        size, checksum = file.stat().st_size, cksum(file)
+        if name is None: name = file.name
+        with self._manifest_lock, open(self.path/'manifest.csv', 'a') as fd:
+            fd.write(f'{tstr},{run_time},{f},{name},{size},{checksum}\n')
+
+    def completed_hours(self, tstr, run_time, verify=True):
+        """Return the forecast hours of a run recorded in the manifest whose files are still intact.
+        With `verify` the size and checksum of each file are checked again."""
+        df = pd.read_csv(self.path/'manifest.csv', dtype={'date':str, 'run':str})
+        df = df.loc[(df.date==str(tstr)) & (df.run==str(run_time))].drop_duplicates('forecast', keep='last')
+        done = []
+        cube = self.cube_name(tstr, run_time)
+        if (self.path/cube).is_file():
+            # Hours written to the cube are checked with its `written` flags
+            with Dataset(self.path/cube) as nc: written = nc['written'][:].filled(0)
+            hours = df.loc[df.file==cube, 'forecast'].values
+            done += [f for f in hours if int(f[1:]) <= len(written) and written[int(f[1:])-1] == 1]
+        for f, name, size, checksum in df.loc[df.file!=cube, ['forecast', 'file', 'size', 'cksum']].values:
+            file = self.path/name
+            if not file.is_file() or file.stat().st_size != size: continue
+            if verify and cksum(file) != checksum: continue
+            done.append(f)
+        return sorted(done)
+
+    def _download_hour(self, tstr, run_time, f):
+        "Download the grib messages for forecast hour `f` to a single file and return its name."
+        files = [file for file in self.search_files(tstr, run_time, f) if file is not None]
+        if len(files) == 0: raise IOError(f'No messages found for the requested bands')
+        name = f'GFS{run_time}z_{f}'
+        if not download_messages(files, self.path/name):
+            raise IOError(f'Unable to download {tstr} {run_time}z {f}')
+        return name
+
+    def cube_name(self, tstr, run_time):
+        "Name of the netcdf cube with all forecast hours of a run."
+        return f'GFS{tstr}_{run_time}z.nc'
+
+    def _create_cube(self, cube, src, ntimes, units, chunks):
+        "Create `cube` with `ntimes` forecast hours and the coordinates and variables of the netcdf `src`."
+        with Dataset(self.path/cube, 'w') as dst:
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            dst.createDimension('time', ntimes)
+            for name, dim in src.dimensions.items():
+                if name != 'time': dst.createDimension(name, len(dim))
+            time = dst.createVariable('time', 'i4', ('time',))
+            time.units = units
+            time[:] = np.arange(1, ntimes+1)
+            dst.createVariable('written', 'u1', ('time',), fill_value=0)
+            for name, var in src.variables.items():
+                dims = tuple(d for d in var.dimensions if d != 'time')
+                attrs = {k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'}
+                if var.dimensions == (name,) and name != 'time':
+                    out = dst.createVariable(name, var.dtype, dims)
+                    out.setncatts(attrs)
+                    out[:] = var[:]
+                elif len(dims) >= 2:
+                    shape = (ntimes,) + tuple(len(src.dimensions[d]) for d in dims)
+                    out = dst.createVariable(name, var.dtype, ('time',) + dims, zlib=True, complevel=4, shuffle=True,
+                                             chunksizes=cube_chunks(shape, chunks),
+                                             fill_value=getattr(var, '_FillValue', None))
+                    out.setncatts(attrs)
+
+    def _append_hour(self, cube, index, name, ntimes, units, chunks):
+        "Write the fields of the netcdf file `name` at time `index` of `cube`, creating it with the first hour."
+        with self._cube_lock, Dataset(self.path/name) as src:
+            if not (self.path/cube).is_file(): self._create_cube(cube, src, ntimes, units, chunks)
+            with Dataset(self.path/cube, 'a') as dst:
+                for v, var in src.variables.items():
+                    if v not in dst.variables or 'time' not in dst[v].dimensions or v == 'time': continue
+                    data = var[:]
+                    if var.dimensions[0] == 'time': data = data[0]
+                    # Keep all the chunks touched by one hour in the cache so each is compressed once
+                    out = dst[v]
+                    chunking = out.chunking()
+                    if chunking != 'contiguous':
+                        nchunks = int(np.prod([np.ceil(n/c) for n, c in zip(out.shape[1:], chunking[1:])]))
+                        out.set_var_chunk_cache(size=int(nchunks*np.prod(chunking)*out.dtype.itemsize*1.2),
+                                                nelems=max(nchunks*2+1, 521))
+                    out[index] = data
+                dst['written'][index] = 1
+
+    def _convert_hour(self, tstr, run_time, f, name, converter='cdo', cube=None, ntimes=None, chunks='field'):
+        """Convert the grib file `name` to netcdf with `cdo` or in-process with `cfgrib` and record it in the manifest.
+        If `cube` is given the fields are written to that run cube at the time index of `f` instead."""
+        # The idx source downloads global fields that are cropped here
+        bbox = self.bbox if self.source == 'idx' and self.bbox != [-180, -90, 180, 90] else None
+        if converter == 'cdo':
+            operator = 'copy' if bbox is None else 'sellonlatbox,{},{},{},{}'.format(bbox[0], bbox[2], bbox[1], bbox[3])
+            subprocess.run(['cdo', '-f', 'nc', operator, name, f'{name}.nc'], cwd=str(self.path), check=True)
+        elif converter == 'cfgrib':
+            grib_to_netcdf(self.path/name, self.path/f'{name}.nc', bbox)
+        else: raise ValueError(f'Unknown converter {converter}, use "cdo" or "cfgrib"')
+        os.remove(self.path/name)
+        if cube is None:
+            self.update_manifest(tstr, run_time, f, self.path/f'{name}.nc')
+            return
+        units = f'hours since {tstr[:4]}-{tstr[4:6]}-{tstr[6:]} {run_time}:00:00'
+        self._append_hour(cube, int(f[1:])-1, f'{name}.nc', ntimes, units, chunks)
+        self.update_manifest(tstr, run_time, f, self.path/f'{name}.nc', name=cube)
+        os.remove(self.path/f'{name}.nc')
+
+    def run(self, to_netcdf=True, delete_old=False, replace=False, max_workers:int=4, convert_workers:int=1,
+            converter:str='cdo', incremental:bool=False, cube:bool=False, chunks='field'):
+        """Download the forecast hours of the last run with `max_workers` parallel downloads.
+        Each hour is converted to netcdf by `convert_workers` workers as soon as it is downloaded,
+        with the `cdo` command line tool or in-process with `converter='cfgrib'`.
+        Completed hours are recorded in `manifest.csv` and only missing or corrupt hours are fetched again
+        unless `replace`. With `incremental` the latest run is processed as its hours are published,
+        so calling `run` again later picks up the new hours. The run is written to `log.csv` once all
+        hours up to `last_forecast` are complete. Returns True when the run is complete.
+        With `cube` each hour is appended to a single compressed netcdf4 file per run (`cube_name`) with
+        dimensions time x level x lat x lon instead of one file per hour; `chunks` is one of 'field',
+        'timeseries' (faster point reads but slower writes) or a tuple (see `cube_chunks`)."""
+        if cube and not to_netcdf: raise ValueError('cube requires to_netcdf=True')
+        if incremental: tstr, run_time, available = self.latest_run()
+        else: (tstr, run_time), available = self.search_times(), None
         log_tstr, log_run_time = self.last_log
 
         if not replace:
@@ -99,33 +417,53 @@ class GFS():
                 if (str(log_tstr) == tstr) and (run_time == f'{log_run_time:02d}'):
                     print('No new run is available.')
                     return False
-            self.update_log(tstr, run_time)
 
         end_forecast = int(self.last_forecast[1:])+1
         forecast_hours = [f'f{i:03d}' for i in range(1,end_forecast)]
-        if delete_old: os.system(f'cd {path}; rm *.nc')
-
-        for f in forecast_hours:
-            print(f'Downloading data for {tstr} {run_time}z {f}.')
-            files = self.search_files(tstr, run_time, f)
-            files = [f for f in files if f is not None]
-            if len(files)>0:
-                for i, file in enumerate(files):
-                    if len(files)>1:
-                        assert os.system(f'wget "{file}" -O {path}/GFS{run_time}z_{i}_{f}') == 0
-                    else:
-                        assert os.system(f'wget "{file}" -O {path}/GFS{run_time}z_{f}') == 0
-                    if to_netcdf:
-                        if len(files)>1:
-                            assert os.system(f'cd {path}; cdo -f nc copy GFS{run_time}z_{i}_{f} GFS{run_time}z_{i}_{f}.nc') == 0
-                        else:
-                            assert os.system(f'cd {path}; cdo -f nc copy GFS{run_time}z_{f} GFS{run_time}z_{f}.nc') == 0
+        done = [] if replace else self.completed_hours(tstr, run_time)
+        if delete_old:
+            keep = pd.read_csv(self.path/'manifest.csv', dtype={'date':str, 'run':str})
+            keep = keep.loc[(keep.date==tstr) & (keep.run==run_time) & keep.forecast.isin(done), 'file'].values
+            for file in self.path.glob('*.nc'):
+                if file.name not in keep: file.unlink()
+        cube_file = self.cube_name(tstr, run_time) if cube else None
+        if cube and replace and (self.path/cube_file).is_file(): (self.path/cube_file).unlink()
+        todo = [f for f in forecast_hours if f not in done and (available is None or f in available)]
+        if len(done)>0: print(f'{len(done)} forecast hours of {tstr} {run_time}z already complete.')
+
+        failed = []
+        with ThreadPoolExecutor(max_workers) as downloads, ThreadPoolExecutor(convert_workers) as conversions:
+            futures = {downloads.submit(self._download_hour, tstr, run_time, f): f for f in todo}
+            conversion_futures = {}
+            for future in as_completed(futures):
+                f = futures[future]
+                try: name = future.result()
+                except Exception as e:
+                    warnings.warn(f'Unable to download {tstr} {run_time}z {f}. Exception {e}', UserWarning)
+                    failed.append(f)
+                    continue
+                print(f'Downloaded data for {tstr} {run_time}z {f}.')
                 if to_netcdf:
-                    if len(files)>1:
-                        os.system(f'cd {path}; cdo -O merge GFS{run_time}z_0_{f}.nc GFS{run_time}z_1_{f}.nc GFS{run_time}z_{f}.nc')
-                        os.system(f'cd {path}; rm GFS{run_time}z_0_{f} GFS{run_time}z_1_{f} GFS{run_time}z_0_{f}.nc GFS_1_{f}.nc')
-                    else:
-                        os.system(f'cd {path}; rm GFS{run_time}z_{f}')
+                    conversion_futures[conversions.submit(self._convert_hour, tstr, run_time, f, name, converter,
+                                                          cube_file, len(forecast_hours), chunks)] = f
+                else:
+                    self.update_manifest(tstr, run_time, f, self.path/name)
+                    done.append(f)
+            for future in as_completed(conversion_futures):
+                f = conversion_futures[future]
+                try:
+                    future.result()
+                    done.append(f)
+                except Exception as e:
+                    warnings.warn(f'Unable to convert {tstr} {run_time}z {f}. Exception {e}', UserWarning)
+                    failed.append(f)
+        if len(failed)>0:
+            warnings.warn(f'Failed forecast hours: {", ".join(sorted(failed))}', UserWarning)
+        missing = [f for f in forecast_hours if f not in done]
+        if len(missing)>0:
+            print(f'{len(missing)} forecast hours of {tstr} {run_time}z are still missing.')
+            return False
+        self.update_log(tstr, run_time)
         return True
 
     def __repr__(self):